@@ -1,11 +1,18 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
 from datetime import datetime, timedelta
-import shutil
-#import os
+import contextlib
+import threading
+import queue
+import heapq
+import os
 import io
 import hashlib
+import hmac
+import importlib.util
+from types import SimpleNamespace
 from pathlib import Path
 import logging
 
@@ -16,26 +23,33 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# Verificar e instalar dependências opcionais
-try:
-    import plotly.graph_objects as go
-    import plotly.express as px
-    PLOTLY_AVAILABLE = True
-except ImportError:
-    PLOTLY_AVAILABLE = False
+# Verificar dependências opcionais sem importá-las (import real só no primeiro uso)
+PLOTLY_AVAILABLE = importlib.util.find_spec('plotly') is not None
+if not PLOTLY_AVAILABLE:
     st.warning("⚠️ Plotly não instalado. Instale com: pip install plotly")
 
 # Para geração de PDF DARF
-try:
+REPORTLAB_AVAILABLE = importlib.util.find_spec('reportlab') is not None
+if not REPORTLAB_AVAILABLE:
+    st.warning("⚠️ ReportLab não instalado. Instale com: pip install reportlab")
+
+def _plotly():
+    """Importa o Plotly no primeiro gráfico (o import custa ~200ms; repetições saem de sys.modules)."""
+    import plotly.graph_objects as go
+    import plotly.express as px
+    return go, px
+
+def _reportlab():
+    """Importa o ReportLab na primeira DARF gerada."""
     from reportlab.lib.pagesizes import A4
     from reportlab.lib import colors
     from reportlab.lib.styles import getSampleStyleSheet
     from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-    from reportlab.lib.units import mm
-    REPORTLAB_AVAILABLE = True
-except ImportError:
-    REPORTLAB_AVAILABLE = False
-    st.warning("⚠️ ReportLab não instalado. Instale com: pip install reportlab")
+    return SimpleNamespace(
+        A4=A4, colors=colors, getSampleStyleSheet=getSampleStyleSheet,
+        SimpleDocTemplate=SimpleDocTemplate, Table=Table, TableStyle=TableStyle,
+        Paragraph=Paragraph, Spacer=Spacer
+    )
 
 # --- CONFIGURAÇÕES INICIAIS ---
 st.set_page_config(
@@ -51,34 +65,144 @@ ETFS_CONHECIDOS = [
     'DIVO11', 'FIND11', 'MATB11', 'GOVE11', 'ISUS11',
     'SPXI11', 'HASH11', 'B5P211', 'XMAL11', 'GOLD11'
 ]
-SENHA_HASH = hashlib.sha256("1234".encode()).hexdigest()
+# sha256("1234") pré-calculado: o módulo é reexecutado a cada rerun
+SENHA_HASH = "03ac674216f3e15c761ee1a5e255f067953623c8b388b4459e13f978d7c846f4"
+
+# --- CONEXÃO COM O BANCO ---
+PRAGMAS_CONEXAO = [
+    'busy_timeout=5000',
+    'synchronous=NORMAL',
+    'temp_store=MEMORY',
+    'cache_size=-65536',
+    'mmap_size=268435456',
+    'foreign_keys=ON'
+]
+
+class ConnectionPool:
+    """Uma conexão de escrita e N conexões somente leitura sobre o banco em WAL.
+
+    Leituras (dashboards) rodam em paralelo; escritas são serializadas por
+    `trava_escrita` na conexão única de escrita.
+    """
+
+    def __init__(self, caminho, tamanho_leitura):
+        self.escrita = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self.escrita.execute('PRAGMA journal_mode=WAL')
+        for pragma in PRAGMAS_CONEXAO:
+            self.escrita.execute(f'PRAGMA {pragma}')
+        self.trava_escrita = threading.Lock()
+        
+        self._leitura = queue.Queue()
+        for _ in range(tamanho_leitura):
+            conn = sqlite3.connect(f'file:{caminho}?mode=ro', uri=True, check_same_thread=False)
+            for pragma in PRAGMAS_CONEXAO:
+                conn.execute(f'PRAGMA {pragma}')
+            self._leitura.put(conn)
+
+    @contextlib.contextmanager
+    def leitura(self):
+        """Empresta uma conexão somente leitura e a devolve ao final."""
+        conn = self._leitura.get()
+        try:
+            yield conn
+        finally:
+            self._leitura.put(conn)
+
+@st.cache_resource
+def get_pool():
+    """Pool de conexões compartilhado entre reruns e sessões."""
+    try:
+        tamanho = int(st.secrets.get('pool_leitura', 8))
+    except FileNotFoundError:
+        tamanho = 8
+    return ConnectionPool('investimentos.db', tamanho)
+
+def get_conn():
+    """Conexão de escrita (autocommit); escritas passam por transacao()."""
+    return get_pool().escrita
+
+def assinatura_banco():
+    """(mtime_ns, tamanho) do banco e do -wal: muda a cada escrita, mesmo no mesmo tick."""
+    assinatura = []
+    for arquivo in ('investimentos.db', 'investimentos.db-wal'):
+        try:
+            info = os.stat(arquivo)
+        except FileNotFoundError:
+            continue
+        assinatura.append((info.st_mtime_ns, info.st_size))
+    return tuple(assinatura)
 
 # --- MIGRAÇÃO DE BANCO DE DADOS ---
+VERSAO_ESQUEMA = 4
+
+# Colunas acrescentadas depois da criação das tabelas (bancos e backups antigos)
+COLUNAS_MIGRADAS = {
+    'operacoes': {
+        'taxa_corretagem': 'REAL DEFAULT 0',
+        'taxa_emolumentos': 'REAL DEFAULT 0',
+    },
+    'darfs': {
+        'st_bdr_imposto': 'REAL',
+        'st_etf_imposto': 'REAL',
+    },
+}
+
 def migrar_banco():
     """Adiciona colunas novas se não existirem."""
-    conn = sqlite3.connect('investimentos.db')
-    c = conn.cursor()
-    
-    # Verificar se colunas existem
-    c.execute("PRAGMA table_info(operacoes)")
-    colunas_existentes = [col[1] for col in c.fetchall()]
-    
-    # Adicionar taxa_corretagem se não existir
-    if 'taxa_corretagem' not in colunas_existentes:
-        try:
-            c.execute("ALTER TABLE operacoes ADD COLUMN taxa_corretagem REAL DEFAULT 0")
-            conn.commit()
-        except Exception as e:
-            logging.error(f"Erro ao comitar no banco: {e}")
-    # Adicionar taxa_emolumentos se não existir
-    if 'taxa_emolumentos' not in colunas_existentes:
-        try:
-            c.execute("ALTER TABLE operacoes ADD COLUMN taxa_emolumentos REAL DEFAULT 0")
-            conn.commit()
-        except Exception as e:
-            logging.error(f"Erro ao comitar no banco: {e}")
-    
-    conn.close()
+    # Versão lida e ALTERs numa única transação, sob a trava de escrita
+    with transacao() as c:
+        # Banco já migrado: nada a verificar
+        if c.execute("PRAGMA user_version").fetchone()[0] >= VERSAO_ESQUEMA:
+            return
+        
+        for tabela, colunas in COLUNAS_MIGRADAS.items():
+            # Verificar se colunas existem
+            c.execute(f"PRAGMA table_info({tabela})")
+            colunas_existentes = [col[1] for col in c.fetchall()]
+            
+            for coluna, definicao in colunas.items():
+                if coluna not in colunas_existentes:
+                    try:
+                        c.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+                    except Exception as e:
+                        logging.error(f"Erro ao comitar no banco: {e}")
+        
+        # Bancos antigos (gravados via to_sql) têm operacoes.id sem PRIMARY KEY e
+        # com nulos: o editor grava por id (ON CONFLICT(id)), então a tabela é refeita
+        c.execute("PRAGMA table_info(operacoes)")
+        if not any(col[1] == 'id' and col[5] for col in c.fetchall()):
+            reconstruir_operacoes(c)
+        
+        c.execute(f"PRAGMA user_version = {VERSAO_ESQUEMA}")
+
+def reconstruir_operacoes(c):
+    """Recria operacoes com id INTEGER PRIMARY KEY, preservando os ids válidos.
+
+    Ids nulos ou repetidos recebem um id novo; datas 'YYYY-MM-DD HH:MM:SS' viram 'YYYY-MM-DD'.
+    """
+    colunas = ', '.join(COLUNAS_OPERACOES[1:])
+    valores = ', '.join(
+        'COALESCE(date(data), data) AS data' if col == 'data' else col
+        for col in COLUNAS_OPERACOES[1:]
+    )
+    c.execute("ALTER TABLE operacoes RENAME TO operacoes_legado")
+    c.execute(TABELA_OPERACOES_SQL)
+    # Ids preservados entram antes, para os gerados pelo AUTOINCREMENT não colidirem
+    c.execute(
+        f"""INSERT INTO operacoes (id, {colunas})
+            SELECT id_novo, {colunas} FROM (
+                SELECT CASE WHEN id IN (SELECT id FROM operacoes_legado
+                                        GROUP BY id HAVING COUNT(*) > 1) THEN NULL
+                            ELSE id END AS id_novo,
+                       {valores}
+                FROM operacoes_legado
+            )
+            ORDER BY id_novo IS NULL, data, hora"""
+    )
+    # Os índices antigos somem junto com a tabela legada
+    c.execute("DROP TABLE operacoes_legado")
+    for indice in INDICES_OPERACOES_SQL:
+        c.execute(indice)
 
 # --- FUNÇÕES DE VALIDAÇÃO ---
 def validar_operacao(ticket, tipo, quantidade, valor, data):
@@ -102,12 +226,14 @@ def validar_operacao(ticket, tipo, quantidade, valor, data):
     
     return erros
 
+# BDRs terminam com 34, 35, 39, 32, 33, 31
+SUFIXOS_BDR = ('34', '35', '39', '32', '33', '31')
+
 def identificar_tipo_ativo(ticket):
     """Identifica se é ação, FII, BDR ou ETF."""
     t = ticket.upper()
     
-    # BDRs terminam com 34, 35, 39, 32, 33, 31
-    if t.endswith(('34', '35', '39', '32', '33', '31')):
+    if t.endswith(SUFIXOS_BDR):
         return 'BDR'
     
     # ETFs - verificar lista conhecida ANTES de classificar como FII
@@ -121,15 +247,27 @@ def identificar_tipo_ativo(ticket):
     # Ações brasileiras (padrão)
     return 'ACAO'
 
-def verificar_venda_descoberto(ticket, quantidade, df_ops):
+def identificar_tipos_ativo(tickets):
+    """Versão vetorizada de identificar_tipo_ativo para uma Series de tickets."""
+    t = tickets.str.upper()
+    tipos = np.select(
+        [t.str.endswith(SUFIXOS_BDR), t.isin(ETFS_CONHECIDOS), t.str.endswith('11')],
+        ['BDR', 'ETF', 'FII'],
+        default='ACAO'
+    )
+    return pd.Series(tipos, index=tickets.index)
+
+def verificar_venda_descoberto(ticket, quantidade):
     """Verifica se a venda seria a descoberto."""
-    if df_ops.empty:
-        return {'descoberto': True, 'qtd_disponivel': 0, 'qtd_faltante': quantidade}
-    
-    ops_ticket = df_ops[df_ops['ticket'] == ticket]
-    compras = ops_ticket[ops_ticket['tipo'] == 'Compra']['quantidade'].sum()
-    vendas = ops_ticket[ops_ticket['tipo'] == 'Venda']['quantidade'].sum()
-    qtd_disponivel = compras - vendas
+    # Saldo do ticket direto no banco (índice ticket, tipo, data)
+    with get_pool().leitura() as conn:
+        qtd_disponivel = conn.execute(
+            """SELECT COALESCE(SUM(CASE tipo WHEN 'Compra' THEN quantidade
+                                             WHEN 'Venda' THEN -quantidade
+                                             ELSE 0 END), 0)
+               FROM operacoes WHERE ticket = ?""",
+            (ticket,)
+        ).fetchone()[0]
     
     if quantidade > qtd_disponivel:
         return {
@@ -151,13 +289,21 @@ def fazer_backup():
         backup_file = backup_dir / f'investimentos_backup_{timestamp}.db'
         
         if Path('investimentos.db').exists():
-            shutil.copy2('investimentos.db', backup_file)
+            # API de backup do SQLite: snapshot consistente, já incluindo o -wal.
+            # Grava num temporário e renomeia: nunca fica um .db pela metade
+            temp_file = backup_file.with_suffix('.tmp')
+            with contextlib.closing(sqlite3.connect(temp_file)) as destino, get_pool().trava_escrita:
+                get_conn().backup(destino, pages=1024)
+                # Backup autocontido, sem arquivos -wal/-shm
+                destino.execute("PRAGMA journal_mode=DELETE")
+            os.replace(temp_file, backup_file)
             
             # Manter apenas últimos 10 backups
-            backups = sorted(backup_dir.glob('*.db'))
+            with os.scandir(backup_dir) as it:
+                backups = [e for e in it if e.name.endswith('.db')]
             if len(backups) > 10:
-                for old in backups[:-10]:
-                    old.unlink()
+                for old in heapq.nsmallest(len(backups) - 10, backups, key=lambda e: e.stat().st_mtime):
+                    os.unlink(old.path)
             
             return True, str(backup_file)
         else:
@@ -165,337 +311,506 @@ def fazer_backup():
     except Exception as e:
         return False, f"Erro: {str(e)}"
 
+@st.cache_data(ttl=5)
 def listar_backups():
-    """Lista backups disponíveis."""
+    """Lista backups disponíveis, do mais recente para o mais antigo."""
     backup_dir = Path('backups')
     if not backup_dir.exists():
         return []
     
-    backups = sorted(backup_dir.glob('*.db'), reverse=True)
-    return [b.name for b in backups]
+    # DirEntry.stat() reaproveita os dados da leitura do diretório
+    with os.scandir(backup_dir) as it:
+        entries = sorted(
+            (e for e in it if e.name.endswith('.db')),
+            key=lambda e: e.stat().st_mtime,
+            reverse=True
+        )
+    return [e.name for e in entries]
 
 def restaurar_backup(backup_name):
     """Restaura um backup."""
     try:
         backup_file = Path('backups') / backup_name
         if backup_file.exists():
-            shutil.copy2(backup_file, 'investimentos.db')
+            # Copiar por cima do arquivo com a conexão WAL aberta corromperia o banco
+            with contextlib.closing(sqlite3.connect(backup_file)) as origem, get_pool().trava_escrita:
+                origem.backup(get_conn())
             return True, "Backup restaurado com sucesso!"
         return False, "Arquivo de backup não encontrado"
     except Exception as e:
         return False, f"Erro: {str(e)}"
 
 # --- FUNÇÕES DE BANCO DE DADOS ---
+# Colunas da tabela operacoes na mesma ordem do CREATE TABLE (PRAGMA table_info)
+COLUNAS_OPERACOES = (
+    'id', 'data', 'ticket', 'tipo', 'quantidade', 'valor',
+    'taxa_corretagem', 'taxa_emolumentos', 'hora'
+)
+INSERT_OPS_SQL = (
+    f"INSERT INTO operacoes ({', '.join(COLUNAS_OPERACOES)}) "
+    f"VALUES ({', '.join('?' * len(COLUNAS_OPERACOES))})"
+)
+
+def linhas_operacoes(df):
+    """Converte o DataFrame de operações em tuplas para o INSERT_OPS_SQL."""
+    df = df.reindex(columns=COLUNAS_OPERACOES)
+    # Células digitadas no editor podem ser inválidas: viram nulo em vez de exceção
+    df['id'] = pd.to_numeric(df['id'], errors='coerce').astype('Int64')
+    df['data'] = pd.to_datetime(df['data'], format='mixed', errors='coerce').dt.strftime('%Y-%m-%d')
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+@contextlib.contextmanager
+def transacao():
+    """Abre uma transação explícita (BEGIN IMMEDIATE/COMMIT) e entrega o cursor.
+
+    Em caso de erro (inclusive no COMMIT) faz ROLLBACK: a conexão de escrita é
+    compartilhada e não pode ficar presa numa transação aberta.
+    """
+    with get_pool().trava_escrita:
+        cursor = get_conn().cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+            cursor.execute("COMMIT")
+        except Exception:
+            if cursor.connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+
+def salvar_operacoes_editadas(edited_ops, df_originais):
+    """Grava as edições do data_editor aplicando só a diferença, chaveada pelo id.
+
+    `df_originais` é a página exibida no editor; só os ids dela podem ser removidos.
+    Retorna a lista de erros; havendo algum, nada é gravado.
+    """
+    originais = {linha[0]: linha for linha in linhas_operacoes(df_originais)}
+    # id fora da página exibida nunca sobrescreve outra linha: vira operação nova
+    editadas = [
+        linha if linha[0] in originais else (None, *linha[1:])
+        for linha in linhas_operacoes(edited_ops)
+    ]
+    
+    ids_editados = {linha[0] for linha in editadas}
+    ids_removidos = [(i,) for i in originais if i not in ids_editados]
+    # Linhas novas (id nulo) ou com algum campo alterado
+    upserts = [linha for linha in editadas if originais.get(linha[0]) != linha]
+    
+    # Data obrigatória: linha nova/alterada com data vazia ou inválida bloqueia a gravação
+    erros = [
+        f"❌ Data inválida na linha {posicao + 1}: '{'' if pd.isna(valor) else valor}'"
+        for posicao, (linha, valor) in enumerate(zip(editadas, edited_ops['data']))
+        if linha[1] is None and originais.get(linha[0]) != linha
+    ]
+    if erros:
+        return erros
+    
+    colunas_update = ', '.join(f"{c} = excluded.{c}" for c in COLUNAS_OPERACOES[1:])
+    with transacao() as cursor:
+        cursor.executemany("DELETE FROM operacoes WHERE id = ?", ids_removidos)
+        cursor.executemany(
+            f"{INSERT_OPS_SQL} ON CONFLICT(id) DO UPDATE SET {colunas_update}",
+            upserts
+        )
+    return []
+
+def limpar_tabela(tabela):
+    """Apaga todos os registros da tabela num único executescript."""
+    conn = get_conn()
+    with get_pool().trava_escrita:
+        try:
+            conn.executescript(f"BEGIN IMMEDIATE; DELETE FROM {tabela}; COMMIT;")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logging.error(f"Erro ao limpar tabela {tabela}: {e}")
+            raise
+
+# Tabela e índices de operações também usados na migração que reconstrói a tabela
+TABELA_OPERACOES_SQL = """CREATE TABLE IF NOT EXISTS operacoes
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         data TEXT, ticket TEXT, tipo TEXT, 
+         quantidade INTEGER, valor REAL, 
+         taxa_corretagem REAL DEFAULT 0,
+         taxa_emolumentos REAL DEFAULT 0,
+         hora TEXT DEFAULT '00:00:00')"""
+INDICES_OPERACOES_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_ops_data_hora ON operacoes(data, hora)",
+    "CREATE INDEX IF NOT EXISTS idx_ops_ticket_tipo_data ON operacoes(ticket, tipo, data)",
+    "CREATE INDEX IF NOT EXISTS idx_tipo ON operacoes(tipo)",
+)
+
+ESQUEMA_SQL = f"""
+    -- Tabela de operações
+    {TABELA_OPERACOES_SQL};
+    
+    -- Tabela de proventos
+    CREATE TABLE IF NOT EXISTS proventos
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         data TEXT, ticket TEXT, tipo TEXT, valor REAL);
+    
+    -- Tabela de DARFs geradas
+    CREATE TABLE IF NOT EXISTS darfs
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         mes_ano TEXT,
+         data_geracao TEXT,
+         valor_total REAL,
+         dt_imposto REAL,
+         st_acao_imposto REAL,
+         st_bdr_imposto REAL,
+         st_etf_imposto REAL,
+         st_fii_imposto REAL,
+         codigo_darf TEXT,
+         vencimento TEXT,
+         arquivo_path TEXT);
+    
+    -- Índices simples substituídos pelos compostos abaixo (são prefixos deles)
+    DROP INDEX IF EXISTS idx_data;
+    DROP INDEX IF EXISTS idx_ticket;
+    DROP INDEX IF EXISTS idx_prov_ticket;
+    
+    {'; '.join(INDICES_OPERACOES_SQL)};
+    CREATE INDEX IF NOT EXISTS idx_prov_ticket_data ON proventos(ticket, data);
+    CREATE INDEX IF NOT EXISTS idx_darf_mes ON darfs(mes_ano);
+"""
+
 def init_db():
     """Inicializa banco de dados com índices para performance."""
-    conn = sqlite3.connect('investimentos.db')
-    c = conn.cursor()
-    
-    # Tabela de operações
-    c.execute('''CREATE TABLE IF NOT EXISTS operacoes
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  data TEXT, ticket TEXT, tipo TEXT, 
-                  quantidade INTEGER, valor REAL, 
-                  taxa_corretagem REAL DEFAULT 0,
-                  taxa_emolumentos REAL DEFAULT 0,
-                  hora TEXT DEFAULT '00:00:00')''')
-    
-    # Tabela de proventos
-    c.execute('''CREATE TABLE IF NOT EXISTS proventos
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  data TEXT, ticket TEXT, tipo TEXT, valor REAL)''')
-    
-    # Tabela de DARFs geradas
-    c.execute('''CREATE TABLE IF NOT EXISTS darfs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  mes_ano TEXT,
-                  data_geracao TEXT,
-                  valor_total REAL,
-                  dt_imposto REAL,
-                  st_acao_imposto REAL,
-                  st_bdr_imposto REAL,
-                  st_etf_imposto REAL,
-                  st_fii_imposto REAL,
-                  codigo_darf TEXT,
-                  vencimento TEXT,
-                  arquivo_path TEXT)''')
-    
-    conn.commit()
-    conn.close()
+    conn = get_conn()
+    
+    # Tabelas e índices numa única transação (um fsync só).
+    # executescript faz COMMIT de transação pendente, por isso o BEGIN vai no script
+    with get_pool().trava_escrita:
+        try:
+            conn.executescript(f"BEGIN IMMEDIATE;\n{ESQUEMA_SQL}\nCOMMIT;")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logging.error(f"Erro ao criar esquema do banco: {e}")
+            raise
     
     # Executar migração
     migrar_banco()
     
-    # Criar índices
-    conn = sqlite3.connect('investimentos.db')
-    c = conn.cursor()
-    try:
-        c.execute('CREATE INDEX IF NOT EXISTS idx_data ON operacoes(data)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_ticket ON operacoes(ticket)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_tipo ON operacoes(tipo)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_prov_ticket ON proventos(ticket)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_darf_mes ON darfs(mes_ano)')
-    except Exception as e: # noqa: E722
-        logging.error(f"Erro ao comitar no banco: {e}")
-    
-    conn.commit()
-    conn.close()
-
-@st.cache_data(ttl=30)
-def carregar_dados():
-    """Carrega dados do banco com cache."""
-    conn = sqlite3.connect('investimentos.db')
-    df_ops = pd.read_sql_query("SELECT * FROM operacoes ORDER BY data ASC, hora ASC", conn)
-    df_prov = pd.read_sql_query("SELECT * FROM proventos ORDER BY data ASC", conn)
-    df_darfs = pd.read_sql_query("SELECT * FROM darfs ORDER BY mes_ano DESC", conn)
-    conn.close()
-    
-    # Garantir que as colunas existam no DataFrame
-    if not df_ops.empty:
-        if 'taxa_corretagem' not in df_ops.columns:
-            df_ops['taxa_corretagem'] = 0.0
-        if 'taxa_emolumentos' not in df_ops.columns:
-            df_ops['taxa_emolumentos'] = 0.0
+    # Estatísticas para o planejador escolher os índices (só na primeira vez)
+    with get_pool().trava_escrita:
+        try:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+                conn.execute('ANALYZE')
+        except Exception as e:
+            logging.error(f"Erro ao gerar estatísticas (ANALYZE): {e}")
+
+@st.cache_data(ttl=30, max_entries=4)
+def carregar_dados(db_assinatura):
+    """Carrega dados do banco com cache.
+
+    `db_assinatura` (assinatura_banco) só serve de chave do cache: uma escrita,
+    inclusive feita fora do app, nunca devolve o frame anterior.
+    A coluna `data` das operações já vem convertida para datetime.
+    """
+    with get_pool().leitura() as conn:
+        df_ops = pd.read_sql_query(
+            f"SELECT {', '.join(COLUNAS_OPERACOES)} FROM operacoes ORDER BY data, hora",
+            conn,
+            parse_dates={'data': {'format': 'ISO8601', 'cache': True}}
+        )
+        df_prov = pd.read_sql_query(
+            "SELECT id, data, ticket, tipo, valor FROM proventos ORDER BY data ASC", conn
+        )
+        df_darfs = pd.read_sql_query(
+            """SELECT id, mes_ano, data_geracao, valor_total, dt_imposto, st_acao_imposto,
+                      st_bdr_imposto, st_etf_imposto, st_fii_imposto, codigo_darf,
+                      vencimento, arquivo_path
+               FROM darfs ORDER BY mes_ano DESC""",
+            conn
+        )
+    
+    # Tipos enxutos (numpy, sem dtypes pyarrow): poucos tickets/tipos distintos
+    # viram category e a quantidade cabe em int32. Valores monetários continuam
+    # float64: float32 perderia centavos nos totais usados no IR.
+    df_ops = df_ops.astype({'ticket': 'category', 'tipo': 'category'})
+    if df_ops['quantidade'].notna().all():
+        df_ops['quantidade'] = df_ops['quantidade'].astype('int32')
     
     return df_ops, df_prov, df_darfs
 
+@st.cache_data(max_entries=4)
+def tickets_conhecidos(db_assinatura, sugeridos):
+    """Tickets já operados mais os sugeridos, em ordem alfabética.
+
+    `db_assinatura` (assinatura_banco) só serve de chave do cache.
+    """
+    with get_pool().leitura() as conn:
+        operados = [t for (t,) in conn.execute(
+            "SELECT DISTINCT ticket FROM operacoes WHERE ticket IS NOT NULL"
+        )]
+    return sorted(set(operados).union(sugeridos))
+
+TAMANHO_PAGINA_EDITOR = 1000
+
+def existem_operacoes():
+    """Verifica se há operações sem carregar a tabela."""
+    with get_pool().leitura() as conn:
+        return bool(conn.execute("SELECT EXISTS(SELECT 1 FROM operacoes)").fetchone()[0])
+
+def carregar_pagina_operacoes(pagina):
+    """Carrega uma página de operações (base 0) para o editor."""
+    with get_pool().leitura() as conn:
+        return pd.read_sql_query(
+            "SELECT * FROM operacoes ORDER BY data, hora, id LIMIT ? OFFSET ?",
+            conn,
+            params=(TAMANHO_PAGINA_EDITOR, pagina * TAMANHO_PAGINA_EDITOR)
+        )
+
 # --- CÁLCULO DE POSIÇÕES E RESULTADOS ---
-def calcular_tudo():
-    """Calcula posições, resultados e IR com prejuízos acumulados."""
-    df_ops, df_prov, df_darfs = carregar_dados()
+def calcular_tudo(db_assinatura=None):
+    """Calcula posições, resultados e IR, reaproveitando o cache enquanto o banco não mudar.
+
+    Passe a `db_assinatura` lida no início da execução para que cálculos e demais
+    caches (gráficos, sugestões) fiquem sob a mesma chave.
+    """
+    if db_assinatura is None:
+        db_assinatura = assinatura_banco()
+    return _calcular_tudo(db_assinatura)
+
+def invalidar_caches():
+    """Descarta dados e cálculos em cache; chamar após qualquer escrita no banco."""
+    carregar_dados.clear()
+    _calcular_tudo.clear()
+
+@st.cache_data(ttl=3600, max_entries=4)
+def _calcular_tudo(db_assinatura):
+    """Calcula posições, resultados e IR com prejuízos acumulados.
+
+    `db_assinatura` só serve de chave do cache: muda a cada escrita no banco.
+    """
+    df_ops, df_prov, df_darfs = carregar_dados(db_assinatura)
     
     if df_ops.empty: 
         return pd.DataFrame(), pd.DataFrame(), df_ops, df_prov, pd.DataFrame(), df_darfs
 
-    df_ops['data'] = pd.to_datetime(df_ops['data'], format='mixed')
-    vendas_realizadas = []
-    controle = {} 
-
-    for data_atual in sorted(df_ops['data'].unique()):
-        data_dt = pd.to_datetime(data_atual)
-        df_dia = df_ops[df_ops['data'] == data_dt].sort_values('hora')
-        
-        for tkt in df_dia['ticket'].unique():
-            if tkt not in controle: 
-                controle[tkt] = {'qtd': 0, 'pm': 0.0}
-            
-            ops_dia = df_dia[df_dia['ticket'] == tkt]
-            vendas_dia = ops_dia[ops_dia['tipo'] == 'Venda']
-            compras_dia = ops_dia[ops_dia['tipo'] == 'Compra']
-            
-            q_c = compras_dia['quantidade'].sum()
-            q_v = vendas_dia['quantidade'].sum()
-            hora_venda = vendas_dia['hora'].iloc[0] if not vendas_dia.empty else "00:00:00"
-            
-            # Calcular custos
-            custo_compra = (
-                compras_dia['taxa_corretagem'].sum() + 
-                compras_dia['taxa_emolumentos'].sum()
-            ) if 'taxa_corretagem' in compras_dia.columns else 0
-            
-            custo_venda = (
-                vendas_dia['taxa_corretagem'].sum() + 
-                vendas_dia['taxa_emolumentos'].sum()
-            ) if 'taxa_corretagem' in vendas_dia.columns else 0
-            
-            # Day Trade
-            qtd_dt = min(q_c, q_v)
-            if qtd_dt > 0:
-                v_compra_m = compras_dia['valor'].mean()
-                v_venda_m = vendas_dia['valor'].mean()
-                resultado_bruto = (v_venda_m - v_compra_m) * qtd_dt
-                resultado_liquido = resultado_bruto - (custo_compra + custo_venda) if qtd_dt == q_c else resultado_bruto - custo_venda
-                
-                vendas_realizadas.append({
-                    'Data': data_dt, 
-                    'Hora': hora_venda, 
-                    'Ticket': tkt, 
-                    'Tipo': 'Day Trade', 
-                    'Tipo Ativo': identificar_tipo_ativo(tkt),
-                    'Resultado': resultado_liquido, 
-                    'Volume Venda': qtd_dt * v_venda_m, 
-                    'Mês/Ano': data_dt.strftime('%Y-%m')
-                })
-
-            # Swing Trade - Compras
-            sobra_c = q_c - qtd_dt
-            if sobra_c > 0:
-                v_compra_m = compras_dia['valor'].mean()
-                custo_medio_unitario = (custo_compra / sobra_c) if sobra_c > 0 else 0
-                novo_total = (controle[tkt]['qtd'] * controle[tkt]['pm']) + (sobra_c * (v_compra_m + custo_medio_unitario))
-                controle[tkt]['qtd'] += sobra_c
-                controle[tkt]['pm'] = novo_total / controle[tkt]['qtd'] if controle[tkt]['qtd'] > 0 else 0
-
-            # Swing Trade - Vendas
-            sobra_v = q_v - qtd_dt
-            if sobra_v > 0:
-                v_venda_m = vendas_dia['valor'].mean()
-                custo_medio_unitario = (custo_venda / sobra_v) if sobra_v > 0 else 0
-                resultado_liquido = (v_venda_m - custo_medio_unitario - controle[tkt]['pm']) * sobra_v
-                
-                vendas_realizadas.append({
-                    'Data': data_dt, 
-                    'Hora': hora_venda, 
-                    'Ticket': tkt, 
-                    'Tipo': 'Swing Trade',
-                    'Tipo Ativo': identificar_tipo_ativo(tkt), 
-                    'Resultado': resultado_liquido, 
-                    'Volume Venda': sobra_v * v_venda_m, 
-                    'Mês/Ano': data_dt.strftime('%Y-%m')
-                })
-                controle[tkt]['qtd'] -= sobra_v
-
-    df_pos = pd.DataFrame([
-        {
-            'Ticket': t, 
-            'Tipo': identificar_tipo_ativo(t),
-            'Quantidade': d['qtd'], 
-            'Preço Médio': d['pm'], 
-            'Total': d['qtd']*d['pm']
-        } 
-        for t, d in controle.items() if d['qtd'] > 0
-    ])
+    # Consolidar compras e vendas por (data, ticket) numa única agregação
+    ops = df_ops[df_ops['tipo'].isin(['Compra', 'Venda'])].assign(
+        custo=df_ops['taxa_corretagem'].fillna(0) + df_ops['taxa_emolumentos'].fillna(0)
+    )
+    agg = (
+        ops.groupby(['data', 'ticket', 'tipo'], observed=True, sort=True)
+        .agg(qtd=('quantidade', 'sum'), preco=('valor', 'mean'), custo=('custo', 'sum'))
+        .unstack('tipo', fill_value=0)
+        .reindex(
+            columns=pd.MultiIndex.from_product([['qtd', 'preco', 'custo'], ['Compra', 'Venda']]),
+            fill_value=0
+        )
+    )
     
-    df_res = pd.DataFrame(vendas_realizadas)
+    q_c = agg[('qtd', 'Compra')]
+    q_v = agg[('qtd', 'Venda')]
+    qtd_dt = np.minimum(q_c, q_v)
+    
+    base = pd.DataFrame({
+        'q_c': q_c,
+        'q_v': q_v,
+        'v_compra_m': agg[('preco', 'Compra')],
+        'v_venda_m': agg[('preco', 'Venda')],
+        'custo_compra': agg[('custo', 'Compra')],
+        'custo_venda': agg[('custo', 'Venda')],
+        'qtd_dt': qtd_dt,
+        'sobra_c': q_c - qtd_dt,
+        'sobra_v': q_v - qtd_dt,
+        'hora_venda': ops[ops['tipo'] == 'Venda'].groupby(['data', 'ticket'], observed=True)['hora'].min(),
+        'primeira_hora': ops.groupby(['data', 'ticket'], observed=True)['hora'].min()
+    }, index=agg.index).reset_index()
+    base['hora_venda'] = base['hora_venda'].fillna("00:00:00")
+    
+    # Mesma ordem do processamento cronológico: data e depois hora da 1ª operação
+    base = base.sort_values(['data', 'primeira_hora'], kind='stable').reset_index(drop=True)
+    
+    # Preço médio depende do estado anterior de cada ticket: único laço restante.
+    # Estado por ticket em vetores indexados pelo código do ticket (ordem de aparição)
+    codigos, tickets = pd.factorize(base['ticket'])
+    qtd = [0] * len(tickets)
+    pm = [0.0] * len(tickets)
+    resultado_st = np.zeros(len(base))
+    colunas_pm = ['sobra_c', 'sobra_v', 'v_compra_m', 'v_venda_m', 'custo_compra', 'custo_venda']
+    
+    for i, (k, (sobra_c, sobra_v, v_compra_m, v_venda_m, custo_compra, custo_venda)) in enumerate(
+        zip(codigos.tolist(), base[colunas_pm].itertuples(index=False, name=None))
+    ):
+        # Swing Trade - Compras
+        if sobra_c > 0:
+            custo_medio_unitario = custo_compra / sobra_c
+            novo_total = (qtd[k] * pm[k]) + (sobra_c * (v_compra_m + custo_medio_unitario))
+            qtd[k] += sobra_c
+            pm[k] = novo_total / qtd[k] if qtd[k] > 0 else 0
+        
+        # Swing Trade - Vendas
+        if sobra_v > 0:
+            custo_medio_unitario = custo_venda / sobra_v
+            resultado_st[i] = (v_venda_m - custo_medio_unitario - pm[k]) * sobra_v
+            qtd[k] -= sobra_v
+    
+    base['Tipo Ativo'] = identificar_tipos_ativo(base['ticket'])
+    # Chave mensal do IR ('YYYY-MM') truncando datetime64 para mês, sem strftime por linha
+    base['Mês/Ano'] = np.datetime_as_string(base['data'].to_numpy().astype('datetime64[M]'))
+    
+    # Day Trade
+    dt = base[base['qtd_dt'] > 0]
+    day_trade = pd.DataFrame({
+        'Data': dt['data'],
+        'Hora': dt['hora_venda'],
+        'Ticket': dt['ticket'],
+        'Tipo': 'Day Trade',
+        'Tipo Ativo': dt['Tipo Ativo'],
+        'Resultado': (dt['v_venda_m'] - dt['v_compra_m']) * dt['qtd_dt'] - np.where(
+            dt['qtd_dt'] == dt['q_c'],
+            dt['custo_compra'] + dt['custo_venda'],
+            dt['custo_venda']
+        ),
+        'Volume Venda': dt['qtd_dt'] * dt['v_venda_m'],
+        'Mês/Ano': dt['Mês/Ano']
+    })
+    
+    # Swing Trade - Vendas
+    mask_st = (base['sobra_v'] > 0).to_numpy()
+    sw = base[mask_st]
+    swing_trade = pd.DataFrame({
+        'Data': sw['data'],
+        'Hora': sw['hora_venda'],
+        'Ticket': sw['ticket'],
+        'Tipo': 'Swing Trade',
+        'Tipo Ativo': sw['Tipo Ativo'],
+        'Resultado': resultado_st[mask_st],
+        'Volume Venda': sw['sobra_v'] * sw['v_venda_m'],
+        'Mês/Ano': sw['Mês/Ano']
+    })
+
+    qtd = np.array(qtd, dtype=base['sobra_c'].dtype)
+    pm = np.array(pm, dtype=float)
+    em_carteira = qtd > 0
+    df_pos = pd.DataFrame({
+        'Ticket': tickets[em_carteira],
+        'Quantidade': qtd[em_carteira],
+        'Preço Médio': pm[em_carteira],
+        'Total': qtd[em_carteira] * pm[em_carteira]
+    })
+    if not df_pos.empty:
+        df_pos.insert(1, 'Tipo', identificar_tipos_ativo(df_pos['Ticket']))
+    
+    # Day Trade antes do Swing Trade de um mesmo (data, ticket)
+    df_res = pd.concat([day_trade, swing_trade]).sort_index(kind='stable').reset_index(drop=True)
+    df_res = df_res.astype({'Tipo': 'category', 'Tipo Ativo': 'category'})
     
     # Calcular IR
     df_ir = calcular_ir_completo(df_res) if not df_res.empty else pd.DataFrame()
     
     return df_pos, df_res, df_ops, df_prov, df_ir, df_darfs
 
-def calcular_ir_completo(df_res):
-    """Calcula IR conforme regras da Receita Federal com prejuízos acumulados."""
-    
-    res_mensal = []
-    
-    # Controle de prejuízos acumulados por tipo
-    # IMPORTANTE: Cada tipo tem pool separado de compensação
-    prejuizos = {
-        'DT': 0,           # Day Trade (todos os ativos)
-        'ST_ACAO': 0,      # Swing Trade - Ações (ÚNICO com isenção R$ 20k)
-        'ST_BDR': 0,       # Swing Trade - BDRs (SEM isenção)
-        'ST_ETF': 0,       # Swing Trade - ETFs (SEM isenção)
-        'ST_FII': 0        # Swing Trade - FIIs (SEM isenção)
-    }
-    
-    for mes in sorted(df_res['Mês/Ano'].unique()):
-        df_m = df_res[df_res['Mês/Ano'] == mes]
-
-        # === DAY TRADE (todos os ativos) ===
-        dt_lucro = df_m[df_m['Tipo'] == 'Day Trade']['Resultado'].sum()
-        dt_lucro_tributavel = dt_lucro + prejuizos['DT']
-
-        if dt_lucro_tributavel > 0:
-            dt_imposto = dt_lucro_tributavel * 0.20
-            prejuizos['DT'] = 0
-        else:
-            dt_imposto = 0
-            prejuizos['DT'] = dt_lucro_tributavel
-
-        # === SWING TRADE - AÇÕES BRASILEIRAS (COM isenção R$ 20k) ===
-        st_acao = df_m[(df_m['Tipo'] == 'Swing Trade') & (df_m['Tipo Ativo'] == 'ACAO')]
-        st_acao_lucro = st_acao['Resultado'].sum()
-        st_acao_volume = st_acao['Volume Venda'].sum()
+# Categorias de compensação de prejuízo e alíquotas
+# IMPORTANTE: Cada tipo tem pool separado de compensação
+ALIQUOTAS_IR = {
+    'DT': 0.20,        # Day Trade (todos os ativos)
+    'ST_ACAO': 0.15,   # Swing Trade - Ações (ÚNICO com isenção R$ 20k)
+    'ST_BDR': 0.15,    # Swing Trade - BDRs (SEM isenção)
+    'ST_ETF': 0.15,    # Swing Trade - ETFs (SEM isenção)
+    'ST_FII': 0.20     # Swing Trade - FIIs (SEM isenção)
+}
+CATEGORIAS_IR = list(ALIQUOTAS_IR)
 
-        
-              
-        if st_acao_volume <= 20000:
-            st_acao_imposto = 0
-            # Mesmo isento, mantém o lucro/prejuízo para controle
-            if st_acao_lucro < 0:
-                prejuizos['ST_ACAO'] += st_acao_lucro
+def compensar_prejuizos(lucros, isento):
+    """Base tributável e prejuízo acumulado mês a mês de uma categoria.
 
+    Meses isentos não pagam imposto nem consomem prejuízo, mas acumulam perdas.
+    """
+    base = np.zeros_like(lucros)
+    prejuizo = np.zeros_like(lucros)
+    acumulado = 0.0
+    # Recorrência mensal (poucas dezenas de meses): laço em floats/bools Python
+    for i, (lucro, mes_isento) in enumerate(zip(lucros.tolist(), isento.tolist())):
+        if mes_isento:
+            if lucro < 0:
+                acumulado += lucro
         else:
-            st_acao_lucro_tributavel = st_acao_lucro + prejuizos['ST_ACAO']
-            if st_acao_lucro_tributavel > 0:
-                st_acao_imposto = st_acao_lucro_tributavel * 0.15
-                prejuizos['ST_ACAO'] = 0
+            tributavel = lucro + acumulado
+            if tributavel > 0:
+                base[i] = tributavel
+                acumulado = 0.0
             else:
-                st_acao_imposto = 0
-                prejuizos['ST_ACAO'] = st_acao_lucro_tributavel
-
-        # === SWING TRADE - BDRs (SEM isenção, 15%) ===
-        st_bdr = df_m[(df_m['Tipo'] == 'Swing Trade') & (df_m['Tipo Ativo'] == 'BDR')]
-        st_bdr_lucro = st_bdr['Resultado'].sum()
-        st_bdr_volume = st_bdr['Volume Venda'].sum()
-        st_bdr_lucro_tributavel = st_bdr_lucro + prejuizos['ST_BDR']
-        
-        if st_bdr_lucro_tributavel > 0:
-            st_bdr_imposto = st_bdr_lucro_tributavel * 0.15
-            prejuizos['ST_BDR'] = 0
-        else:
-            st_bdr_imposto = 0
-            prejuizos['ST_BDR'] = st_bdr_lucro_tributavel
-
-        # === SWING TRADE - ETFs (SEM isenção, 15%) ===
-        st_etf = df_m[(df_m['Tipo'] == 'Swing Trade') & (df_m['Tipo Ativo'] == 'ETF')]
-        st_etf_lucro = st_etf['Resultado'].sum()
-        st_etf_volume = st_etf['Volume Venda'].sum()
-        st_etf_lucro_tributavel = st_etf_lucro + prejuizos['ST_ETF']
-        
-        if st_etf_lucro_tributavel > 0:
-            st_etf_imposto = st_etf_lucro_tributavel * 0.15
-            prejuizos['ST_ETF'] = 0
-        else:
-            st_etf_imposto = 0
-            prejuizos['ST_ETF'] = st_etf_lucro_tributavel
-
-        # === SWING TRADE - FIIs (SEM isenção, 20%) ===
-        st_fii = df_m[(df_m['Tipo'] == 'Swing Trade') & (df_m['Tipo Ativo'] == 'FII')]
-        st_fii_lucro = st_fii['Resultado'].sum()
-        st_fii_volume = st_fii['Volume Venda'].sum()
-        st_fii_lucro_tributavel = st_fii_lucro + prejuizos['ST_FII']
-
-        if st_fii_lucro_tributavel > 0:
-            st_fii_imposto = st_fii_lucro_tributavel * 0.20
-            prejuizos['ST_FII'] = 0
-        else:
-            st_fii_imposto = 0
-            prejuizos['ST_FII'] = st_fii_lucro_tributavel
-
-        # Total de impostos
-        total_ir = dt_imposto + st_acao_imposto + st_bdr_imposto + st_etf_imposto + st_fii_imposto
+                acumulado = tributavel
+        prejuizo[i] = acumulado
+    return base, prejuizo
 
-        res_mensal.append({
-            'Mês/Ano': mes,
-            
-            # Day Trade
-            'Lucro DT': dt_lucro,
-            'Prej. DT Acum.': prejuizos['DT'],
-            'Imposto DT (20%)': dt_imposto,
-            
-            # Ações (COM isenção)
-            'Lucro ST Ações': st_acao_lucro,
-            'Volume ST Ações': st_acao_volume,
-            'Isento Ações?': 'Sim' if st_acao_volume <= 20000 else 'Não',
-            'Prej. ST Ações': prejuizos['ST_ACAO'],
-            'Imposto ST Ações (15%)': st_acao_imposto,
-            
-            # BDRs (SEM isenção)
-            'Lucro ST BDR': st_bdr_lucro,
-            'Volume ST BDR': st_bdr_volume,
-            'Prej. ST BDR': prejuizos['ST_BDR'],
-            'Imposto ST BDR (15%)': st_bdr_imposto,
-            
-            # ETFs (SEM isenção)
-            'Lucro ST ETF': st_etf_lucro,
-            'Volume ST ETF': st_etf_volume,
-            'Prej. ST ETF': prejuizos['ST_ETF'],
-            'Imposto ST ETF (15%)': st_etf_imposto,
-            
-            # FIIs (SEM isenção)
-            'Lucro ST FII': st_fii_lucro,
-            'Volume ST FII': st_fii_volume,
-            'Prej. ST FII': prejuizos['ST_FII'],
-            'Imposto ST FII (20%)': st_fii_imposto,
-            
-            # Total
-            'Total IR': total_ir
-        })
+def calcular_ir_completo(df_res):
+    """Calcula IR conforme regras da Receita Federal com prejuízos acumulados."""
     
-    return pd.DataFrame(res_mensal)
+    # Lucro e volume de venda por mês x categoria em um único groupby
+    categoria = np.where(df_res['Tipo'] == 'Day Trade', 'DT', 'ST_' + df_res['Tipo Ativo'].astype(str))
+    por_mes = (
+        df_res.groupby(['Mês/Ano', categoria])[['Resultado', 'Volume Venda']]
+        .sum()
+        .unstack(fill_value=0)
+    )
+    lucros = por_mes['Resultado'].reindex(columns=CATEGORIAS_IR, fill_value=0).astype(float)
+    volumes = por_mes['Volume Venda'].reindex(columns=CATEGORIAS_IR, fill_value=0).astype(float)
+    
+    # Apenas ações brasileiras têm isenção de R$ 20k/mês em swing trade
+    isento_acao = (volumes['ST_ACAO'] <= 20000).to_numpy()
+    sem_isencao = np.zeros(len(lucros), dtype=np.bool_)
+    
+    impostos = {}
+    prejuizos = {}
+    for cat, aliquota in ALIQUOTAS_IR.items():
+        isento = isento_acao if cat == 'ST_ACAO' else sem_isencao
+        base, prejuizos[cat] = compensar_prejuizos(lucros[cat].to_numpy(), isento)
+        impostos[cat] = base * aliquota
+    
+    df_ir = pd.DataFrame({'Mês/Ano': lucros.index})
+    
+    # Day Trade
+    df_ir['Lucro DT'] = lucros['DT'].to_numpy()
+    df_ir['Prej. DT Acum.'] = prejuizos['DT']
+    df_ir['Imposto DT (20%)'] = impostos['DT']
+    
+    # Ações (COM isenção)
+    df_ir['Lucro ST Ações'] = lucros['ST_ACAO'].to_numpy()
+    df_ir['Volume ST Ações'] = volumes['ST_ACAO'].to_numpy()
+    df_ir['Isento Ações?'] = np.where(isento_acao, 'Sim', 'Não')
+    df_ir['Prej. ST Ações'] = prejuizos['ST_ACAO']
+    df_ir['Imposto ST Ações (15%)'] = impostos['ST_ACAO']
+    
+    # BDRs (SEM isenção)
+    df_ir['Lucro ST BDR'] = lucros['ST_BDR'].to_numpy()
+    df_ir['Volume ST BDR'] = volumes['ST_BDR'].to_numpy()
+    df_ir['Prej. ST BDR'] = prejuizos['ST_BDR']
+    df_ir['Imposto ST BDR (15%)'] = impostos['ST_BDR']
+    
+    # ETFs (SEM isenção)
+    df_ir['Lucro ST ETF'] = lucros['ST_ETF'].to_numpy()
+    df_ir['Volume ST ETF'] = volumes['ST_ETF'].to_numpy()
+    df_ir['Prej. ST ETF'] = prejuizos['ST_ETF']
+    df_ir['Imposto ST ETF (15%)'] = impostos['ST_ETF']
+    
+    # FIIs (SEM isenção)
+    df_ir['Lucro ST FII'] = lucros['ST_FII'].to_numpy()
+    df_ir['Volume ST FII'] = volumes['ST_FII'].to_numpy()
+    df_ir['Prej. ST FII'] = prejuizos['ST_FII']
+    df_ir['Imposto ST FII (20%)'] = impostos['ST_FII']
+    
+    # Total
+    df_ir['Total IR'] = sum(impostos.values())
+    
+    return df_ir
 
 # --- FUNÇÃO: CALCULAR RESULTADOS DO DIA ---
+def fatia_periodo(df_res, data_inicio, data_fim):
+    """Resultados com Data entre data_inicio e data_fim (inclusive).
+
+    df_res sai de calcular_tudo ordenado por Data: o período é uma fatia contígua,
+    localizada por busca binária em datetime64, sem criar objetos date por linha.
+    """
+    inicio, fim = pd.Timestamp(data_inicio), pd.Timestamp(data_fim) + pd.Timedelta(days=1)
+    i, j = df_res['Data'].searchsorted([inicio, fim])
+    return df_res.iloc[i:j]
+
 def calcular_resultados_dia(df_res, data_referencia=None):
     """Calcula resultados das operações do dia."""
     if df_res.empty:
@@ -504,15 +819,7 @@ def calcular_resultados_dia(df_res, data_referencia=None):
     if data_referencia is None:
         data_referencia = datetime.now().date()
     
-    # Converter coluna Data para datetime se necessário
-    if not pd.api.types.is_datetime64_any_dtype(df_res['Data']):
-        df_res_temp = df_res.copy()
-        df_res_temp['Data'] = pd.to_datetime(df_res_temp['Data'])
-    else:
-        df_res_temp = df_res
-    
-    # Filtrar operações do dia
-    df_dia = df_res_temp[df_res_temp['Data'].dt.date == data_referencia]
+    df_dia = fatia_periodo(df_res, data_referencia, data_referencia)
     
     if df_dia.empty:
         return None
@@ -535,8 +842,18 @@ def calcular_resultados_dia(df_res, data_referencia=None):
     
     taxa_acerto = (ops_positivas / num_operacoes * 100) if num_operacoes > 0 else 0
     
+    # Resumo por ticket (sem ordenar grupos: o resultado é ordenado por Resultado)
+    por_ticket = df_dia.groupby(
+        'Ticket', observed=True, sort=False, as_index=False
+    ).agg(**{
+        'Resultado': ('Resultado', 'sum'),
+        'Volume': ('Volume Venda', 'sum'),
+        'Nº Ops': ('Tipo', 'size')
+    }).sort_values('Resultado', ascending=False)
+    
     return {
         'df_operacoes': df_dia,
+        'por_ticket': por_ticket,
         'resultado_total': resultado_total,
         'volume_total': volume_total,
         'num_operacoes': num_operacoes,
@@ -600,30 +917,42 @@ def calcular_resultados_mes(df_res, mes_ano=None):
     }
 
 # --- FUNÇÕES DE GERAÇÃO DE PDF DARF ---
+@st.cache_resource
+def estilos_darf():
+    """Folha de estilos e TableStyle da DARF, montados uma única vez por processo."""
+    rl = _reportlab()
+    styles = rl.getSampleStyleSheet()
+    tabela_style = rl.TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), rl.colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), rl.colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -2), rl.colors.beige),
+        ('GRID', (0, 0), (-1, -1), 1, rl.colors.black),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+    ])
+    return styles, tabela_style
+
 def gerar_darf_pdf(mes_ano, df_ir_mes, tipo_imposto='CONSOLIDADO'):
-    """Gera PDF da DARF com dados fiscais."""
+    """Gera PDF da DARF em memória e retorna (bytes, mensagem)."""
     
     if not REPORTLAB_AVAILABLE:
         return None, "ReportLab não instalado. Instale com: pip install reportlab"
     
     try:
-        # Criar diretório de DARFs
-        darf_dir = Path('darfs')
-        darf_dir.mkdir(exist_ok=True)
-        
-        # Nome do arquivo
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = darf_dir / f'DARF_{mes_ano}_{tipo_imposto}_{timestamp}.pdf'
-        
-        # Criar PDF
-        doc = SimpleDocTemplate(str(filename), pagesize=A4)
+        # Criar PDF em memória
+        rl = _reportlab()
+        buf = io.BytesIO()
+        doc = rl.SimpleDocTemplate(buf, pagesize=rl.A4)
         story = []
-        styles = getSampleStyleSheet()
+        styles, tabela_style = estilos_darf()
         
         # Título
-        titulo = Paragraph("<b>DOCUMENTO DE ARRECADAÇÃO DE RECEITAS FEDERAIS - DARF</b>", styles['Title'])
+        titulo = rl.Paragraph("<b>DOCUMENTO DE ARRECADAÇÃO DE RECEITAS FEDERAIS - DARF</b>", styles['Title'])
         story.append(titulo)
-        story.append(Spacer(1, 20))
+        story.append(rl.Spacer(1, 20))
         
         # Informações gerais
         info_text = f"""
@@ -631,8 +960,8 @@ def gerar_darf_pdf(mes_ano, df_ir_mes, tipo_imposto='CONSOLIDADO'):
         <b>Data de Geração:</b> {datetime.now().strftime('%d/%m/%Y %H:%M')}<br/>
         <b>Tipo:</b> {tipo_imposto}<br/>
         """
-        story.append(Paragraph(info_text, styles['Normal']))
-        story.append(Spacer(1, 20))
+        story.append(rl.Paragraph(info_text, styles['Normal']))
+        story.append(rl.Spacer(1, 20))
         
         # Tabela de valores
         dados_tabela = [
@@ -642,52 +971,42 @@ def gerar_darf_pdf(mes_ano, df_ir_mes, tipo_imposto='CONSOLIDADO'):
         total = 0
         
         if tipo_imposto == 'CONSOLIDADO' or tipo_imposto == 'DAY_TRADE':
-            dt_valor = df_ir_mes['Imposto DT (20%)'].iloc[0]
+            dt_valor = df_ir_mes['Imposto DT (20%)'].iat[0]
             if dt_valor > 0:
                 dados_tabela.append(['Day Trade', '6015', '20%', f'{dt_valor:.2f}'])
                 total += dt_valor
         
         if tipo_imposto == 'CONSOLIDADO' or tipo_imposto == 'SWING_ACAO':
-            st_acao_valor = df_ir_mes['Imposto ST Ações (15%)'].iloc[0]
+            st_acao_valor = df_ir_mes['Imposto ST Ações (15%)'].iat[0]
             if st_acao_valor > 0:
                 dados_tabela.append(['Swing Trade - Ações', '6015', '15%', f'{st_acao_valor:.2f}'])
                 total += st_acao_valor
         
         if tipo_imposto == 'CONSOLIDADO' or tipo_imposto == 'SWING_BDR':
-            st_bdr_valor = df_ir_mes['Imposto ST BDR (15%)'].iloc[0]
+            st_bdr_valor = df_ir_mes['Imposto ST BDR (15%)'].iat[0]
             if st_bdr_valor > 0:
                 dados_tabela.append(['Swing Trade - BDRs', '6015', '15%', f'{st_bdr_valor:.2f}'])
                 total += st_bdr_valor
         
         if tipo_imposto == 'CONSOLIDADO' or tipo_imposto == 'SWING_ETF':
-            st_etf_valor = df_ir_mes['Imposto ST ETF (15%)'].iloc[0]
+            st_etf_valor = df_ir_mes['Imposto ST ETF (15%)'].iat[0]
             if st_etf_valor > 0:
                 dados_tabela.append(['Swing Trade - ETFs', '6015', '15%', f'{st_etf_valor:.2f}'])
                 total += st_etf_valor
         
         if tipo_imposto == 'CONSOLIDADO' or tipo_imposto == 'SWING_FII':
-            st_fii_valor = df_ir_mes['Imposto ST FII (20%)'].iloc[0]
+            st_fii_valor = df_ir_mes['Imposto ST FII (20%)'].iat[0]
             if st_fii_valor > 0:
                 dados_tabela.append(['Swing Trade - FIIs', '8523', '20%', f'{st_fii_valor:.2f}'])
                 total += st_fii_valor
         
         dados_tabela.append(['', '', '<b>TOTAL</b>', f'<b>{total:.2f}</b>'])
         
-        tabela = Table(dados_tabela, colWidths=[200, 80, 80, 100])
-        tabela.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
-        ]))
+        tabela = rl.Table(dados_tabela, colWidths=[200, 80, 80, 100])
+        tabela.setStyle(tabela_style)
         
         story.append(tabela)
-        story.append(Spacer(1, 30))
+        story.append(rl.Spacer(1, 30))
         
         # Vencimento
         mes_ref = datetime.strptime(mes_ano, '%Y-%m')
@@ -697,8 +1016,8 @@ def gerar_darf_pdf(mes_ano, df_ir_mes, tipo_imposto='CONSOLIDADO'):
         <b>VENCIMENTO:</b> {vencimento.strftime('%d/%m/%Y')}<br/>
         <b>Código de Barras:</b> [Gerar no site da Receita Federal]<br/>
         """
-        story.append(Paragraph(venc_text, styles['Normal']))
-        story.append(Spacer(1, 20))
+        story.append(rl.Paragraph(venc_text, styles['Normal']))
+        story.append(rl.Spacer(1, 20))
         
         # Observações
         obs_text = """
@@ -710,66 +1029,97 @@ def gerar_darf_pdf(mes_ano, df_ir_mes, tipo_imposto='CONSOLIDADO'):
         5. Prejuízos podem ser compensados em meses futuros<br/>
         6. ATENÇÃO: Apenas ações brasileiras têm isenção de R$ 20.000/mês em swing trade<br/>
         """
-        story.append(Paragraph(obs_text, styles['Normal']))
+        story.append(rl.Paragraph(obs_text, styles['Normal']))
         
         # Gerar PDF
         doc.build(story)
         
-        return str(filename), f"DARF gerada com sucesso: {filename.name}"
+        return buf.getvalue(), "DARF gerada com sucesso"
         
     except Exception as e:
         return None, f"Erro ao gerar DARF: {str(e)}"
 
+def salvar_darf_arquivo(mes_ano, tipo_imposto, pdf_bytes):
+    """Grava o PDF da DARF em disco para o histórico e retorna o caminho."""
+    darf_dir = Path('darfs')
+    darf_dir.mkdir(exist_ok=True)
+    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = darf_dir / f'DARF_{mes_ano}_{tipo_imposto}_{timestamp}.pdf'
+    filename.write_bytes(pdf_bytes)
+    return filename
+
+@st.cache_data(max_entries=32)
+def ler_darf_arquivo(arquivo_path, mtime_ns):
+    """Bytes do PDF de uma DARF salva.
+
+    `mtime_ns` só serve de chave do cache: regravar o arquivo invalida a entrada.
+    """
+    return Path(arquivo_path).read_bytes()
+
 def salvar_darf_bd(mes_ano, df_ir_mes, arquivo_path):
     """Salva registro da DARF no banco de dados."""
     try:
         mes_ref = datetime.strptime(mes_ano, '%Y-%m')
         vencimento = (mes_ref + timedelta(days=32)).replace(day=20)
         
-        conn = sqlite3.connect('investimentos.db')
-        conn.execute(
-            """INSERT INTO darfs 
-               (mes_ano, data_geracao, valor_total, dt_imposto, st_acao_imposto, st_bdr_imposto, 
-                st_etf_imposto, st_fii_imposto, codigo_darf, vencimento, arquivo_path) 
-               VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
-            (
-                mes_ano,
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                df_ir_mes['Total IR'].iloc[0],
-                df_ir_mes['Imposto DT (20%)'].iloc[0],
-                df_ir_mes['Imposto ST Ações (15%)'].iloc[0],
-                df_ir_mes['Imposto ST BDR (15%)'].iloc[0],
-                df_ir_mes['Imposto ST ETF (15%)'].iloc[0],
-                df_ir_mes['Imposto ST FII (20%)'].iloc[0],
-                '6015/8523',
-                vencimento.strftime('%Y-%m-%d'),
-                arquivo_path
+        with transacao() as cursor:
+            cursor.execute(
+                """INSERT INTO darfs 
+                   (mes_ano, data_geracao, valor_total, dt_imposto, st_acao_imposto, st_bdr_imposto, 
+                    st_etf_imposto, st_fii_imposto, codigo_darf, vencimento, arquivo_path) 
+                   VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+                (
+                    mes_ano,
+                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    df_ir_mes['Total IR'].iat[0],
+                    df_ir_mes['Imposto DT (20%)'].iat[0],
+                    df_ir_mes['Imposto ST Ações (15%)'].iat[0],
+                    df_ir_mes['Imposto ST BDR (15%)'].iat[0],
+                    df_ir_mes['Imposto ST ETF (15%)'].iat[0],
+                    df_ir_mes['Imposto ST FII (20%)'].iat[0],
+                    '6015/8523',
+                    vencimento.strftime('%Y-%m-%d'),
+                    arquivo_path
+                )
             )
-        )
-        conn.commit()
-        conn.close()
         return True
     except Exception as e:
         st.error(f"Erro ao salvar DARF no BD: {e}")
         return False
 
 # --- FUNÇÕES DE EXPORTAÇÃO ---
+def escrever_aba_excel(writer, df, nome_aba, formato_cabecalho):
+    """Escreve o DataFrame linha a linha, como exige o modo constant_memory."""
+    worksheet = writer.book.add_worksheet(nome_aba)
+    worksheet.write_row(0, 0, list(df.columns), formato_cabecalho)
+    valores = df.astype(object).where(df.notna(), None)
+    for i, linha in enumerate(valores.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(i, 0, linha)
+
 def gerar_relatorio_excel(df_pos, df_res, df_ir, df_prov):
     """Gera relatório completo em Excel."""
     output = io.BytesIO()
     
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+    opcoes = {
+        'constant_memory': True,
+        'strings_to_numbers': False,
+        'default_date_format': 'yyyy-mm-dd'
+    }
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': opcoes}) as writer:
+        cabecalho = writer.book.add_format({'bold': True, 'border': 1, 'align': 'center'})
+        
         if not df_ir.empty:
-            df_ir.to_excel(writer, sheet_name='Resumo IR', index=False)
+            escrever_aba_excel(writer, df_ir, 'Resumo IR', cabecalho)
         
         if not df_pos.empty:
-            df_pos.to_excel(writer, sheet_name='Posição Atual', index=False)
+            escrever_aba_excel(writer, df_pos, 'Posição Atual', cabecalho)
         
         if not df_res.empty:
-            df_res.to_excel(writer, sheet_name='Operações Realizadas', index=False)
+            escrever_aba_excel(writer, df_res, 'Operações Realizadas', cabecalho)
         
         if not df_prov.empty:
-            df_prov.to_excel(writer, sheet_name='Proventos', index=False)
+            escrever_aba_excel(writer, df_prov, 'Proventos', cabecalho)
     
     return output.getvalue()
 
@@ -780,7 +1130,7 @@ def gerar_alertas(df_pos, df_ir, df_res):
     
     # Alerta de IR a pagar
     if not df_ir.empty:
-        ir_atual = df_ir.iloc[-1]['Total IR']
+        ir_atual = df_ir['Total IR'].iat[-1]
         if ir_atual > 10:
             alertas.append({
                 'tipo': 'warning',
@@ -790,9 +1140,9 @@ def gerar_alertas(df_pos, df_ir, df_res):
     # Alerta de concentração
     if not df_pos.empty and len(df_pos) > 1:
         total = df_pos['Total'].sum()
-        max_valor = df_pos['Total'].max()
-        percentual_max = (max_valor / total) * 100
-        ticket_max = df_pos.loc[df_pos['Total'].idxmax(), 'Ticket']
+        maior = df_pos.nlargest(1, 'Total').iloc[0]
+        percentual_max = (maior['Total'] / total) * 100
+        ticket_max = maior['Ticket']
         
         if percentual_max > 30:
             alertas.append({
@@ -803,11 +1153,11 @@ def gerar_alertas(df_pos, df_ir, df_res):
     # Alerta de prejuízo acumulado
     if not df_ir.empty:
         prejuizos_totais = (
-            df_ir.iloc[-1]['Prej. DT Acum.'] +
-            df_ir.iloc[-1]['Prej. ST Ações'] +
-            df_ir.iloc[-1]['Prej. ST BDR'] +
-            df_ir.iloc[-1]['Prej. ST ETF'] +
-            df_ir.iloc[-1]['Prej. ST FII']
+            df_ir['Prej. DT Acum.'].iat[-1] +
+            df_ir['Prej. ST Ações'].iat[-1] +
+            df_ir['Prej. ST BDR'].iat[-1] +
+            df_ir['Prej. ST ETF'].iat[-1] +
+            df_ir['Prej. ST FII'].iat[-1]
         )
         
         if prejuizos_totais < -1000:
@@ -825,49 +1175,89 @@ def gerar_alertas(df_pos, df_ir, df_res):
     
     return alertas
 
+# --- FORMATAÇÃO DE TABELAS ---
+FORMATO_MOEDA = 'R$ {:.2f}'  # str.format (texto pré-formatado)
+MOEDA = 'R$ %.2f'            # printf do column_config
+
+def formatar_colunas(df, formatos):
+    """Cópia do DataFrame com as colunas já convertidas em texto formatado.
+
+    Só para tabelas que ainda precisam de Styler (cor de fundo): nelas o Styler
+    envia os próprios textos e o column_config não teria efeito.
+    """
+    df = df.copy()
+    for coluna, fmt in formatos.items():
+        df[coluna] = df[coluna].map(fmt.format)
+    return df
+
+def config_numerica(formatos):
+    """column_config com formatação numérica no frontend (dados seguem numéricos)."""
+    return {
+        coluna: st.column_config.NumberColumn(format=fmt)
+        for coluna, fmt in formatos.items()
+    }
+
+def classificar_resultados(resultado):
+    """Status e CSS de fundo por sinal do resultado, das mesmas máscaras."""
+    sinais = [resultado > 0, resultado < 0]
+    status = np.select(sinais, ['✅ Lucro', '❌ Prejuízo'], default='➖ Zero')
+    cores = np.select(sinais, ['background-color: #d4edda', 'background-color: #f8d7da'], default='')
+    return status, cores
+
 # --- FUNÇÕES DE DASHBOARD ---
-def criar_grafico_evolucao_patrimonio(df_res, df_pos):
+# Os gráficos são cacheados como dict. A chave é uma assinatura barata do que
+# gerou os dados (assinatura_banco + período do filtro); o DataFrame vai em
+# parâmetro com "_" e não é hasheado pelo Streamlit
+def criar_grafico_evolucao_patrimonio(df_res, chave):
     """Cria gráfico de evolução do patrimônio."""
-    if not PLOTLY_AVAILABLE:
+    if not PLOTLY_AVAILABLE or df_res.empty:
         return None
     
-    # Patrimônio atual
-    patrimonio_atual = df_pos['Total'].sum() if not df_pos.empty else 0
+    return _grafico_evolucao_patrimonio(chave, df_res)
+
+@st.cache_data(ttl=300)
+def _grafico_evolucao_patrimonio(chave, _df_res):
+    """Figura (dict) do lucro acumulado, cacheada pela chave."""
+    go, px = _plotly()
+    df_res = _df_res[['Data', 'Resultado']]
     
     # Lucro acumulado
-    if not df_res.empty:
-        df_res_sorted = df_res.sort_values('Data')
-        df_res_sorted['Lucro Acumulado'] = df_res_sorted['Resultado'].cumsum()
-        
-        fig = go.Figure()
-        
-        fig.add_trace(go.Scatter(
-            x=df_res_sorted['Data'],
-            y=df_res_sorted['Lucro Acumulado'],
-            mode='lines+markers',
-            name='Lucro Acumulado',
-            line=dict(color='#667eea', width=3),
-            fill='tozeroy'
-        ))
-        
-        fig.update_layout(
-            title='Evolução do Lucro/Prejuízo Acumulado',
-            xaxis_title='Data',
-            yaxis_title='Valor (R$)',
-            hovermode='x unified',
-            height=400
-        )
-        
-        return fig
+    df_res_sorted = df_res.sort_values('Data')
+    df_res_sorted['Lucro Acumulado'] = df_res_sorted['Resultado'].cumsum()
+    
+    fig = go.Figure()
+    
+    fig.add_trace(go.Scatter(
+        x=df_res_sorted['Data'],
+        y=df_res_sorted['Lucro Acumulado'],
+        mode='lines+markers',
+        name='Lucro Acumulado',
+        line=dict(color='#667eea', width=3),
+        fill='tozeroy'
+    ))
+    
+    fig.update_layout(
+        title='Evolução do Lucro/Prejuízo Acumulado',
+        xaxis_title='Data',
+        yaxis_title='Valor (R$)',
+        hovermode='x unified',
+        height=400
+    )
     
-    return None
+    return fig.to_dict()
 
-def criar_grafico_volume_mensal(df_res):
+def criar_grafico_volume_mensal(df_res, chave):
     """Cria gráfico de volume de vendas mensal."""
     if not PLOTLY_AVAILABLE or df_res.empty:
         return None
     
-    volume_mensal = df_res.groupby('Mês/Ano')['Volume Venda'].sum().reset_index()
+    return _grafico_volume_mensal(chave, df_res)
+
+@st.cache_data(ttl=300)
+def _grafico_volume_mensal(chave, _df_res):
+    """Figura (dict) do volume de vendas por mês, cacheada pela chave."""
+    go, px = _plotly()
+    volume_mensal = _df_res.groupby('Mês/Ano', observed=True)['Volume Venda'].sum().reset_index()
     
     fig = go.Figure()
     
@@ -885,15 +1275,22 @@ def criar_grafico_volume_mensal(df_res):
         height=400
     )
     
-    return fig
+    return fig.to_dict()
 
-def criar_grafico_pizza_carteira(df_pos):
+def criar_grafico_pizza_carteira(df_pos, chave):
     """Cria gráfico pizza da composição da carteira."""
     if not PLOTLY_AVAILABLE or df_pos.empty:
         return None
     
+    return _grafico_pizza_carteira(chave, df_pos)
+
+@st.cache_data(ttl=300)
+def _grafico_pizza_carteira(chave, _df_pos):
+    """Figura (dict) da composição da carteira, cacheada pela chave."""
+    go, px = _plotly()
+    
     fig = px.pie(
-        df_pos,
+        _df_pos,
         values='Total',
         names='Ticket',
         title='Composição da Carteira',
@@ -903,14 +1300,20 @@ def criar_grafico_pizza_carteira(df_pos):
     fig.update_traces(textposition='inside', textinfo='percent+label')
     fig.update_layout(height=400)
     
-    return fig
+    return fig.to_dict()
 
-def criar_grafico_pl_tipo(df_res):
+def criar_grafico_pl_tipo(df_res, chave):
     """Cria gráfico de P&L por tipo de operação."""
     if not PLOTLY_AVAILABLE or df_res.empty:
         return None
     
-    pl_tipo = df_res.groupby('Tipo')['Resultado'].sum().reset_index()
+    return _grafico_pl_tipo(chave, df_res)
+
+@st.cache_data(ttl=300)
+def _grafico_pl_tipo(chave, _df_res):
+    """Figura (dict) do P&L por tipo de operação, cacheada pela chave."""
+    go, px = _plotly()
+    pl_tipo = _df_res.groupby('Tipo', observed=True)['Resultado'].sum().reset_index()
     
     fig = go.Figure()
     
@@ -931,7 +1334,144 @@ def criar_grafico_pl_tipo(df_res):
         height=400
     )
     
-    return fig
+    return fig.to_dict()
+
+# --- FRAGMENTOS DA INTERFACE ---
+# Interações dentro de um fragmento reexecutam só o fragmento; gravações no banco
+# seguem com st.rerun() (app inteiro) para atualizar os cálculos.
+@st.fragment
+def form_operacao(tickets_existentes):
+    """Formulário de nova operação."""
+    with st.form("form_operacao", clear_on_submit=True):
+        col1, col2, col3 = st.columns(3)
+        
+        ticket_select = col1.selectbox("🎫 Ticket", tickets_existentes)
+        ticket_novo = col1.text_input("Novo Ticket (se selecionou ➕)").upper().strip()
+        tipo_op = col2.selectbox("📊 Tipo", ["Compra", "Venda"])
+        data_op = col3.date_input("📅 Data", datetime.now())
+        
+        col4, col5, col6 = st.columns(3)
+        qtd_op = col4.number_input("🔢 Quantidade", min_value=1, value=100)
+        val_op = col5.number_input("💵 Preço Unitário", min_value=0.01, value=10.0, step=0.01)
+        hora_op = col6.time_input("🕐 Hora", datetime.now().time())
+        
+        col7, col8 = st.columns(2)
+        taxa_corretagem = col7.number_input("💸 Corretagem", min_value=0.0, value=0.0, step=0.01)
+        taxa_emolumentos = col8.number_input("💸 Emolumentos", min_value=0.0, value=0.0, step=0.01)
+        
+        st.markdown("---")
+        
+        submit_btn = st.form_submit_button("💾 Salvar Operação", use_container_width=True)
+        
+        if submit_btn:
+            ticket_final = ticket_novo if ticket_select == "➕ DIGITAR NOVO..." else ticket_select
+            
+            # Validar
+            erros = validar_operacao(ticket_final, tipo_op, qtd_op, val_op, data_op)
+            
+            if erros:
+                for erro in erros:
+                    st.error(erro)
+            else:
+                # Verificar venda a descoberto
+                if tipo_op == "Venda":
+                    check = verificar_venda_descoberto(ticket_final, qtd_op)
+                    if check['descoberto']:
+                        st.warning("⚠️ **ATENÇÃO: Venda a Descoberto!**")
+                        st.info(f"📊 Disponível: {check['qtd_disponivel']} | Faltante: {check['qtd_faltante']}")
+                        st.error("⛔ Operação bloqueada. Verifique sua posição.")
+                        st.stop()
+                
+                # Salvar
+                with transacao() as cursor:
+                    cursor.execute(
+                        """INSERT INTO operacoes 
+                           (data, ticket, tipo, quantidade, valor, taxa_corretagem, taxa_emolumentos, hora) 
+                           VALUES (?,?,?,?,?,?,?,?)""",
+                        (data_op.strftime('%Y-%m-%d'), ticket_final, tipo_op, qtd_op, val_op,
+                         taxa_corretagem, taxa_emolumentos, hora_op.strftime('%H:%M:%S'))
+                    )
+                
+                # Limpar cache
+                invalidar_caches()
+                
+                # Mostrar tipo identificado
+                tipo_ativo = identificar_tipo_ativo(ticket_final)
+                st.success(f"✅ Operação registrada: {tipo_op} de {qtd_op} {ticket_final} @ R$ {val_op:.2f}")
+                st.info(f"🏷️ Tipo identificado: {tipo_ativo}")
+                st.balloons()
+                st.rerun()
+
+@st.fragment
+def download_darf(df_darfs):
+    """Seleção e download de uma DARF já gerada."""
+    # Download de DARF específica
+    st.subheader("📥 Download de DARF")
+    
+    darf_selecionada = st.selectbox(
+        "Selecione a DARF",
+        df_darfs['mes_ano'].tolist()
+    )
+    
+    darf_info = df_darfs[df_darfs['mes_ano'] == darf_selecionada].iloc[0]
+    
+    arquivo = Path(darf_info['arquivo_path'])
+    if arquivo.exists():
+        st.download_button(
+            label=f"📥 Baixar DARF {darf_selecionada}",
+            data=ler_darf_arquivo(str(arquivo), arquivo.stat().st_mtime_ns),
+            file_name=arquivo.name,
+            mime="application/pdf",
+            use_container_width=True
+        )
+    else:
+        st.error("⚠️ Arquivo não encontrado")
+
+@st.fragment
+def historico_ticket(df_ops, df_prov, df_pos):
+    """Operações, proventos e posição de um ticket escolhido."""
+    # ticket é category (carregar_dados): as categorias já são os tickets distintos, ordenados
+    todos_tickets = df_ops['ticket'].cat.categories.tolist() if not df_ops.empty else []
+    
+    if todos_tickets:
+        ticket_escolhido = st.selectbox("🎫 Selecione o Ticket", todos_tickets)
+        
+        # Mostrar tipo do ativo
+        tipo_ativo = identificar_tipo_ativo(ticket_escolhido)
+        st.info(f"🏷️ Tipo: **{tipo_ativo}**")
+        
+        tab1, tab2, tab3 = st.tabs(["📝 Operações", "💰 Proventos", "📊 Resumo"])
+        
+        with tab1:
+            ops_ticket = df_ops[df_ops['ticket'] == ticket_escolhido].sort_values(
+                ['data', 'hora'], 
+                ascending=False
+            )
+            st.dataframe(ops_ticket, use_container_width=True, hide_index=True)
+        
+        with tab2:
+            if not df_prov.empty:
+                prov_ticket = df_prov[df_prov['ticket'] == ticket_escolhido]
+                if not prov_ticket.empty:
+                    st.dataframe(prov_ticket, use_container_width=True, hide_index=True)
+                    st.metric("💰 Total Proventos", f"R$ {prov_ticket['valor'].sum():.2f}")
+                else:
+                    st.info("📭 Sem proventos para este ticket")
+            else:
+                st.info("📭 Sem proventos registrados")
+        
+        with tab3:
+            pos_ticket = df_pos[df_pos['Ticket'] == ticket_escolhido]
+            
+            if not pos_ticket.empty:
+                col1, col2, col3 = st.columns(3)
+                col1.metric("🔢 Quantidade", int(pos_ticket['Quantidade'].iat[0]))
+                col2.metric("💵 Preço Médio", f"R$ {pos_ticket['Preço Médio'].iat[0]:.2f}")
+                col3.metric("💼 Total Investido", f"R$ {pos_ticket['Total'].iat[0]:.2f}")
+            else:
+                st.info("📭 Sem posição atual neste ativo")
+    else:
+        st.info("📭 Nenhuma operação registrada")
 
 # --- LOGIN ---
 init_db()
@@ -953,8 +1493,9 @@ if not st.session_state['autenticado']:
             login_btn = st.form_submit_button("Entrar", use_container_width=True)
             
             if login_btn:
-                senha_hash = hashlib.sha256(senha.encode()).hexdigest()
-                if usuario == "admin" and senha_hash == SENHA_HASH:
+                if usuario == "admin" and hmac.compare_digest(
+                    hashlib.sha256(senha.encode()).hexdigest(), SENHA_HASH
+                ):
                     st.session_state['autenticado'] = True
                     st.rerun()
                 else:
@@ -981,6 +1522,7 @@ else:
         if st.button("💾 Backup Manual", use_container_width=True):
             sucesso, mensagem = fazer_backup()
             if sucesso:
+                listar_backups.clear()
                 st.success(f"✅ {mensagem}")
             else:
                 st.error(f"❌ {mensagem}")
@@ -991,8 +1533,10 @@ else:
             st.session_state['autenticado'] = False
             st.rerun()
     
-    # Carregar dados
-    df_pos, df_res, df_ops, df_prov, df_ir, df_darfs = calcular_tudo()
+    # Carregar dados. A assinatura é lida uma vez por execução: uma escrita no meio
+    # do caminho não pode guardar gráficos de dados antigos sob a chave nova
+    assinatura = assinatura_banco()
+    df_pos, df_res, df_ops, df_prov, df_ir, df_darfs = calcular_tudo(assinatura)
     
     # --- PÁGINAS ---
     
@@ -1007,10 +1551,12 @@ else:
         patrimonio = df_pos['Total'].sum() if not df_pos.empty else 0
         lucro_consolidado = df_res['Resultado'].sum() if not df_res.empty else 0
         proventos = df_prov['valor'].sum() if not df_prov.empty else 0
-        ir_mes = df_ir.iloc[-1]['Total IR'] if not df_ir.empty else 0
+        ir_mes = df_ir['Total IR'].iat[-1] if not df_ir.empty else 0
         
-        # Calcular lucro do mês atual
-        mes_atual = datetime.now().strftime('%Y-%m')
+        # Calcular lucro do mês atual (datas formatadas uma vez para a página toda)
+        agora = datetime.now()
+        mes_atual = agora.strftime('%Y-%m')
+        nome_mes_atual = agora.strftime('%B/%Y').capitalize()
         lucro_mes_atual = df_res[df_res['Mês/Ano'] == mes_atual]['Resultado'].sum() if not df_res.empty else 0
         
         col1.metric("💼 Patrimônio", f"R$ {patrimonio:,.2f}")
@@ -1027,9 +1573,9 @@ else:
         st.markdown("---")
         
         # === SEÇÃO 2: RESUMO DO MÊS ATUAL ===
-        st.markdown(f"### 📅 Desempenho do Mês - {datetime.now().strftime('%B/%Y').capitalize()}")
+        st.markdown(f"### 📅 Desempenho do Mês - {nome_mes_atual}")
         
-        resultados_mes = calcular_resultados_mes(df_res)
+        resultados_mes = calcular_resultados_mes(df_res, mes_atual)
         
         if resultados_mes:
             # Métricas do mês
@@ -1071,6 +1617,7 @@ else:
             
             # Gráfico de composição do mês
             if PLOTLY_AVAILABLE:
+                go, _ = _plotly()
                 col_a, col_b = st.columns(2)
                 
                 with col_a:
@@ -1113,14 +1660,14 @@ else:
                     st.plotly_chart(fig, use_container_width=True)
             
         else:
-            st.info(f"📭 Nenhuma operação realizada em {datetime.now().strftime('%B/%Y').capitalize()}")
+            st.info(f"📭 Nenhuma operação realizada em {nome_mes_atual}")
         
         st.markdown("---")
         
         # === SEÇÃO 3: RESULTADOS DO DIA ===
-        st.markdown(f"### 📅 Resultados de Hoje ({datetime.now().strftime('%d/%m/%Y')})")
+        st.markdown(f"### 📅 Resultados de Hoje ({agora.strftime('%d/%m/%Y')})")
         
-        resultados_dia = calcular_resultados_dia(df_res)
+        resultados_dia = calcular_resultados_dia(df_res, agora.date())
         
         if resultados_dia:
             # Métricas do dia
@@ -1165,26 +1712,21 @@ else:
                 if 'Hora' in df_dia_display.columns:
                     df_dia_display['Hora'] = df_dia_display['Hora'].astype(str)
                 
-                # Adicionar emoji visual ao resultado
-                df_dia_display['Status'] = df_dia_display['Resultado'].apply(
-                    lambda x: '✅ Lucro' if x > 0 else '❌ Prejuízo' if x < 0 else '➖ Zero'
-                )
+                # Adicionar emoji visual ao resultado (cores usadas no Styler abaixo)
+                status, cores = classificar_resultados(df_dia_display['Resultado'].to_numpy())
+                df_dia_display['Status'] = status
                 
                 # Reordenar colunas
                 colunas_exibir = ['Hora', 'Ticket', 'Tipo', 'Tipo Ativo', 'Status', 'Resultado', 'Volume Venda']
                 df_dia_display = df_dia_display[colunas_exibir]
                 
+                df_dia_display = formatar_colunas(df_dia_display, {
+                    'Resultado': FORMATO_MOEDA,
+                    'Volume Venda': FORMATO_MOEDA
+                })
+                
                 st.dataframe(
-                    df_dia_display.style.format({
-                        'Resultado': 'R$ {:.2f}',
-                        'Volume Venda': 'R$ {:.2f}'
-                    }).apply(
-                        lambda x: ['background-color: #d4edda' if v > 0 
-                                  else 'background-color: #f8d7da' if v < 0 
-                                  else '' for v in df_dia_display['Resultado']], 
-                        axis=0,
-                        subset=['Resultado']
-                    ),
+                    df_dia_display.style.apply(lambda _: cores, axis=0, subset=['Resultado']),
                     use_container_width=True,
                     hide_index=True
                 )
@@ -1192,19 +1734,11 @@ else:
                 # Resumo por ticket
                 st.markdown("#### 🎯 Resultado por Ticket Hoje")
                 
-                resultado_por_ticket = resultados_dia['df_operacoes'].groupby('Ticket').agg({
-                    'Resultado': 'sum',
-                    'Volume Venda': 'sum',
-                    'Tipo': 'count'
-                }).reset_index()
-                
-                resultado_por_ticket.columns = ['Ticket', 'Resultado', 'Volume', 'Nº Ops']
-                resultado_por_ticket = resultado_por_ticket.sort_values('Resultado', ascending=False)
-                
                 st.dataframe(
-                    resultado_por_ticket.style.format({
-                        'Resultado': 'R$ {:.2f}',
-                        'Volume': 'R$ {:.2f}'
+                    resultados_dia['por_ticket'],
+                    column_config=config_numerica({
+                        'Resultado': MOEDA,
+                        'Volume': MOEDA
                     }),
                     use_container_width=True,
                     hide_index=True
@@ -1238,10 +1772,11 @@ else:
             
             # Adicionar análise de variação (se houver dados históricos)
             st.dataframe(
-                df_display.style.format({
-                    'Preço Médio': 'R$ {:.2f}',
-                    'Total': 'R$ {:.2f}',
-                    '% Carteira': '{:.2f}%'
+                df_display,
+                column_config=config_numerica({
+                    'Preço Médio': MOEDA,
+                    'Total': MOEDA,
+                    '% Carteira': '%.2f%%'
                 }),
                 use_container_width=True,
                 hide_index=True
@@ -1249,7 +1784,7 @@ else:
             
             # Gráfico de composição da carteira
             if PLOTLY_AVAILABLE and len(df_pos) > 1:
-                fig = criar_grafico_pizza_carteira(df_pos)
+                fig = criar_grafico_pizza_carteira(df_pos, assinatura)
                 if fig:
                     st.plotly_chart(fig, use_container_width=True)
     
@@ -1274,10 +1809,7 @@ else:
         
         # Filtrar dados
         if not df_res.empty:
-            df_res_filtrado = df_res[
-                (pd.to_datetime(df_res['Data']).dt.date >= data_inicio) &
-                (pd.to_datetime(df_res['Data']).dt.date <= data_fim)
-            ]
+            df_res_filtrado = fatia_periodo(df_res, data_inicio, data_fim)
         else:
             df_res_filtrado = df_res
         
@@ -1287,10 +1819,12 @@ else:
         col1, col2, col3, col4 = st.columns(4)
         
         if not df_res_filtrado.empty:
-            lucro_periodo = df_res_filtrado['Resultado'].sum()
-            volume_periodo = df_res_filtrado['Volume Venda'].sum()
-            num_ops = len(df_res_filtrado)
-            taxa_acerto = len(df_res_filtrado[df_res_filtrado['Resultado'] > 0]) / num_ops * 100 if num_ops > 0 else 0
+            # Métricas direto nos arrays numpy, sem materializar sub-DataFrames
+            resultado = df_res_filtrado['Resultado'].to_numpy()
+            lucro_periodo = resultado.sum()
+            volume_periodo = df_res_filtrado['Volume Venda'].to_numpy().sum()
+            num_ops = len(resultado)
+            taxa_acerto = (resultado > 0).mean() * 100
             
             col1.metric("💰 P&L Período", f"R$ {lucro_periodo:,.2f}")
             col2.metric("📊 Volume Negociado", f"R$ {volume_periodo:,.2f}")
@@ -1299,7 +1833,8 @@ else:
         
         st.markdown("---")
         
-        # Gráficos
+        # Gráficos (cache por estado do banco + período filtrado)
+        chave_graficos = (assinatura, data_inicio, data_fim)
         tab1, tab2, tab3, tab4 = st.tabs([
             "📈 Evolução P&L",
             "📊 Volume Mensal",
@@ -1308,28 +1843,28 @@ else:
         ])
         
         with tab1:
-            fig = criar_grafico_evolucao_patrimonio(df_res_filtrado, df_pos)
+            fig = criar_grafico_evolucao_patrimonio(df_res_filtrado, chave_graficos)
             if fig:
                 st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("Sem dados para exibir")
         
         with tab2:
-            fig = criar_grafico_volume_mensal(df_res_filtrado)
+            fig = criar_grafico_volume_mensal(df_res_filtrado, chave_graficos)
             if fig:
                 st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("Sem dados para exibir")
         
         with tab3:
-            fig = criar_grafico_pizza_carteira(df_pos)
+            fig = criar_grafico_pizza_carteira(df_pos, assinatura)
             if fig:
                 st.plotly_chart(fig, use_container_width=True)
             else:
                 st.info("Sem dados para exibir")
         
         with tab4:
-            fig = criar_grafico_pl_tipo(df_res_filtrado)
+            fig = criar_grafico_pl_tipo(df_res_filtrado, chave_graficos)
             if fig:
                 st.plotly_chart(fig, use_container_width=True)
             else:
@@ -1338,79 +1873,16 @@ else:
     elif pag == "📝 Registrar Operação":
         st.header("📝 Nova Operação")
         
-        tickets_existentes = sorted(list(set(
-            df_ops['ticket'].tolist() if not df_ops.empty else [] + BLUE_CHIPS + FIIS + ETFS_CONHECIDOS
-        )))
-        tickets_existentes.insert(0, "➕ DIGITAR NOVO...")
+        tickets_existentes = ["➕ DIGITAR NOVO...", *tickets_conhecidos(
+            assinatura, (*BLUE_CHIPS, *FIIS, *ETFS_CONHECIDOS)
+        )]
         
-        with st.form("form_operacao", clear_on_submit=True):
-            col1, col2, col3 = st.columns(3)
-            
-            ticket_select = col1.selectbox("🎫 Ticket", tickets_existentes)
-            ticket_novo = col1.text_input("Novo Ticket (se selecionou ➕)").upper().strip()
-            tipo_op = col2.selectbox("📊 Tipo", ["Compra", "Venda"])
-            data_op = col3.date_input("📅 Data", datetime.now())
-            
-            col4, col5, col6 = st.columns(3)
-            qtd_op = col4.number_input("🔢 Quantidade", min_value=1, value=100)
-            val_op = col5.number_input("💵 Preço Unitário", min_value=0.01, value=10.0, step=0.01)
-            hora_op = col6.time_input("🕐 Hora", datetime.now().time())
-            
-            col7, col8 = st.columns(2)
-            taxa_corretagem = col7.number_input("💸 Corretagem", min_value=0.0, value=0.0, step=0.01)
-            taxa_emolumentos = col8.number_input("💸 Emolumentos", min_value=0.0, value=0.0, step=0.01)
-            
-            st.markdown("---")
-            
-            submit_btn = st.form_submit_button("💾 Salvar Operação", use_container_width=True)
-            
-            if submit_btn:
-                ticket_final = ticket_novo if ticket_select == "➕ DIGITAR NOVO..." else ticket_select
-                
-                # Validar
-                erros = validar_operacao(ticket_final, tipo_op, qtd_op, val_op, data_op)
-                
-                if erros:
-                    for erro in erros:
-                        st.error(erro)
-                else:
-                    # Verificar venda a descoberto
-                    if tipo_op == "Venda":
-                        check = verificar_venda_descoberto(ticket_final, qtd_op, df_ops)
-                        if check['descoberto']:
-                            st.warning("⚠️ **ATENÇÃO: Venda a Descoberto!**")
-                            st.info(f"📊 Disponível: {check['qtd_disponivel']} | Faltante: {check['qtd_faltante']}")
-                            st.error("⛔ Operação bloqueada. Verifique sua posição.")
-                            st.stop()
-                    
-                    # Salvar
-                    conn = sqlite3.connect('investimentos.db')
-                    conn.execute(
-                        """INSERT INTO operacoes 
-                           (data, ticket, tipo, quantidade, valor, taxa_corretagem, taxa_emolumentos, hora) 
-                           VALUES (?,?,?,?,?,?,?,?)""",
-                        (data_op.strftime('%Y-%m-%d'), ticket_final, tipo_op, qtd_op, val_op,
-                         taxa_corretagem, taxa_emolumentos, hora_op.strftime('%H:%M:%S'))
-                    )
-                    conn.commit()
-                    conn.close()
-                    
-                    # Limpar cache
-                    carregar_dados.clear()
-                    
-                    # Mostrar tipo identificado
-                    tipo_ativo = identificar_tipo_ativo(ticket_final)
-                    st.success(f"✅ Operação registrada: {tipo_op} de {qtd_op} {ticket_final} @ R$ {val_op:.2f}")
-                    st.info(f"🏷️ Tipo identificado: {tipo_ativo}")
-                    st.balloons()
-                    st.rerun()
+        form_operacao(tickets_existentes)
     
     elif pag == "💰 Registrar Proventos":
         st.header("💰 Registrar Proventos")
         
-        tickets_proventos = sorted(list(set(
-            df_ops['ticket'].tolist() if not df_ops.empty else [] + BLUE_CHIPS + FIIS
-        )))
+        tickets_proventos = tickets_conhecidos(assinatura, (*BLUE_CHIPS, *FIIS))
         
         with st.form("form_provento", clear_on_submit=True):
             col1, col2 = st.columns(2)
@@ -1423,15 +1895,13 @@ else:
             st.markdown("---")
             
             if st.form_submit_button("💾 Salvar Provento", use_container_width=True):
-                conn = sqlite3.connect('investimentos.db')
-                conn.execute(
-                    "INSERT INTO proventos (data, ticket, tipo, valor) VALUES (?,?,?,?)",
-                    (data_prov.strftime('%Y-%m-%d'), ticket_prov, tipo_prov, valor_prov)
-                )
-                conn.commit()
-                conn.close()
+                with transacao() as cursor:
+                    cursor.execute(
+                        "INSERT INTO proventos (data, ticket, tipo, valor) VALUES (?,?,?,?)",
+                        (data_prov.strftime('%Y-%m-%d'), ticket_prov, tipo_prov, valor_prov)
+                    )
                 
-                carregar_dados.clear()
+                invalidar_caches()
                 
                 st.success(f"✅ Provento registrado: {tipo_prov} de R$ {valor_prov:.2f} - {ticket_prov}")
                 st.rerun()
@@ -1445,10 +1915,11 @@ else:
             df_display['% Carteira'] = (df_pos['Total'] / total_patrimonio * 100).round(2)
             
             st.dataframe(
-                df_display.style.format({
-                    'Preço Médio': 'R$ {:.2f}',
-                    'Total': 'R$ {:.2f}',
-                    '% Carteira': '{:.2f}%'
+                df_display,
+                column_config=config_numerica({
+                    'Preço Médio': MOEDA,
+                    'Total': MOEDA,
+                    '% Carteira': '%.2f%%'
                 }),
                 use_container_width=True,
                 hide_index=True
@@ -1473,27 +1944,10 @@ else:
             """)
             
             st.dataframe(
-                df_ir.style.format({
-                    'Lucro DT': 'R$ {:.2f}',
-                    'Prej. DT Acum.': 'R$ {:.2f}',
-                    'Imposto DT (20%)': 'R$ {:.2f}',
-                    'Lucro ST Ações': 'R$ {:.2f}',
-                    'Volume ST Ações': 'R$ {:.2f}',
-                    'Prej. ST Ações': 'R$ {:.2f}',
-                    'Imposto ST Ações (15%)': 'R$ {:.2f}',
-                    'Lucro ST BDR': 'R$ {:.2f}',
-                    'Volume ST BDR': 'R$ {:.2f}',
-                    'Prej. ST BDR': 'R$ {:.2f}',
-                    'Imposto ST BDR (15%)': 'R$ {:.2f}',
-                    'Lucro ST ETF': 'R$ {:.2f}',
-                    'Volume ST ETF': 'R$ {:.2f}',
-                    'Prej. ST ETF': 'R$ {:.2f}',
-                    'Imposto ST ETF (15%)': 'R$ {:.2f}',
-                    'Lucro ST FII': 'R$ {:.2f}',
-                    'Volume ST FII': 'R$ {:.2f}',
-                    'Prej. ST FII': 'R$ {:.2f}',
-                    'Imposto ST FII (20%)': 'R$ {:.2f}',
-                    'Total IR': 'R$ {:.2f}'
+                df_ir,
+                column_config=config_numerica({
+                    coluna: MOEDA
+                    for coluna in df_ir.columns if coluna not in ('Mês/Ano', 'Isento Ações?')
                 }),
                 use_container_width=True,
                 hide_index=True
@@ -1516,9 +1970,10 @@ else:
             st.subheader("📝 Detalhamento das Operações")
             
             st.dataframe(
-                df_res.style.format({
-                    'Resultado': 'R$ {:.2f}',
-                    'Volume Venda': 'R$ {:.2f}'
+                df_res,
+                column_config=config_numerica({
+                    'Resultado': MOEDA,
+                    'Volume Venda': MOEDA
                 }),
                 use_container_width=True,
                 hide_index=True
@@ -1556,37 +2011,37 @@ else:
                     st.subheader("Resumo do Mês")
                     
                     col1, col2, col3, col4, col5 = st.columns(5)
-                    col1.metric("Day Trade (20%)", f"R$ {df_ir_mes['Imposto DT (20%)'].iloc[0]:.2f}")
-                    col2.metric("Ações (15%)", f"R$ {df_ir_mes['Imposto ST Ações (15%)'].iloc[0]:.2f}")
-                    col3.metric("BDRs (15%)", f"R$ {df_ir_mes['Imposto ST BDR (15%)'].iloc[0]:.2f}")
-                    col4.metric("ETFs (15%)", f"R$ {df_ir_mes['Imposto ST ETF (15%)'].iloc[0]:.2f}")
-                    col5.metric("FIIs (20%)", f"R$ {df_ir_mes['Imposto ST FII (20%)'].iloc[0]:.2f}")
+                    col1.metric("Day Trade (20%)", f"R$ {df_ir_mes['Imposto DT (20%)'].iat[0]:.2f}")
+                    col2.metric("Ações (15%)", f"R$ {df_ir_mes['Imposto ST Ações (15%)'].iat[0]:.2f}")
+                    col3.metric("BDRs (15%)", f"R$ {df_ir_mes['Imposto ST BDR (15%)'].iat[0]:.2f}")
+                    col4.metric("ETFs (15%)", f"R$ {df_ir_mes['Imposto ST ETF (15%)'].iat[0]:.2f}")
+                    col5.metric("FIIs (20%)", f"R$ {df_ir_mes['Imposto ST FII (20%)'].iat[0]:.2f}")
                     
-                    st.metric("**TOTAL IR**", f"R$ {df_ir_mes['Total IR'].iloc[0]:.2f}")
+                    st.metric("**TOTAL IR**", f"R$ {df_ir_mes['Total IR'].iat[0]:.2f}")
                     
                     st.markdown("---")
                     
                     if st.button("📄 Gerar PDF da DARF", type="primary", use_container_width=True):
-                        arquivo_path, mensagem = gerar_darf_pdf(mes_selecionado, df_ir_mes, tipo_darf)
+                        pdf_bytes, mensagem = gerar_darf_pdf(mes_selecionado, df_ir_mes, tipo_darf)
                         
-                        if arquivo_path:
-                            # Salvar no BD
-                            salvar_darf_bd(mes_selecionado, df_ir_mes, arquivo_path)
+                        if pdf_bytes:
+                            # Persistir para o histórico e salvar no BD
+                            arquivo = salvar_darf_arquivo(mes_selecionado, tipo_darf, pdf_bytes)
+                            salvar_darf_bd(mes_selecionado, df_ir_mes, str(arquivo))
                             
                             # Limpar cache
-                            carregar_dados.clear()
+                            invalidar_caches()
                             
-                            st.success(mensagem)
+                            st.success(f"{mensagem}: {arquivo.name}")
                             
-                            # Disponibilizar download
-                            with open(arquivo_path, 'rb') as f:
-                                st.download_button(
-                                    label="📥 Baixar DARF em PDF",
-                                    data=f.read(),
-                                    file_name=Path(arquivo_path).name,
-                                    mime="application/pdf",
-                                    use_container_width=True
-                                )
+                            # Disponibilizar download direto da memória
+                            st.download_button(
+                                label="📥 Baixar DARF em PDF",
+                                data=pdf_bytes,
+                                file_name=arquivo.name,
+                                mime="application/pdf",
+                                use_container_width=True
+                            )
                         else:
                             st.error(mensagem)
                 
@@ -1614,13 +2069,14 @@ else:
             
             if not df_darfs.empty:
                 st.dataframe(
-                    df_darfs.style.format({
-                        'valor_total': 'R$ {:.2f}',
-                        'dt_imposto': 'R$ {:.2f}',
-                        'st_acao_imposto': 'R$ {:.2f}',
-                        'st_bdr_imposto': 'R$ {:.2f}',
-                        'st_etf_imposto': 'R$ {:.2f}',
-                        'st_fii_imposto': 'R$ {:.2f}'
+                    df_darfs,
+                    column_config=config_numerica({
+                        'valor_total': MOEDA,
+                        'dt_imposto': MOEDA,
+                        'st_acao_imposto': MOEDA,
+                        'st_bdr_imposto': MOEDA,
+                        'st_etf_imposto': MOEDA,
+                        'st_fii_imposto': MOEDA
                     }),
                     use_container_width=True,
                     hide_index=True
@@ -1628,74 +2084,14 @@ else:
                 
                 st.markdown("---")
                 
-                # Download de DARF específica
-                st.subheader("📥 Download de DARF")
-                
-                darf_selecionada = st.selectbox(
-                    "Selecione a DARF",
-                    df_darfs['mes_ano'].tolist()
-                )
-                
-                darf_info = df_darfs[df_darfs['mes_ano'] == darf_selecionada].iloc[0]
-                
-                if Path(darf_info['arquivo_path']).exists():
-                    with open(darf_info['arquivo_path'], 'rb') as f:
-                        st.download_button(
-                            label=f"📥 Baixar DARF {darf_selecionada}",
-                            data=f.read(),
-                            file_name=Path(darf_info['arquivo_path']).name,
-                            mime="application/pdf",
-                            use_container_width=True
-                        )
-                else:
-                    st.error("⚠️ Arquivo não encontrado")
+                download_darf(df_darfs)
             else:
                 st.info("📭 Nenhuma DARF gerada ainda")
     
     elif pag == "🔍 Histórico por Ticket":
         st.header("🔍 Consultar Ativo Específico")
         
-        todos_tickets = sorted(df_ops['ticket'].unique().tolist()) if not df_ops.empty else []
-        
-        if todos_tickets:
-            ticket_escolhido = st.selectbox("🎫 Selecione o Ticket", todos_tickets)
-            
-            # Mostrar tipo do ativo
-            tipo_ativo = identificar_tipo_ativo(ticket_escolhido)
-            st.info(f"🏷️ Tipo: **{tipo_ativo}**")
-            
-            tab1, tab2, tab3 = st.tabs(["📝 Operações", "💰 Proventos", "📊 Resumo"])
-            
-            with tab1:
-                ops_ticket = df_ops[df_ops['ticket'] == ticket_escolhido].sort_values(
-                    ['data', 'hora'], 
-                    ascending=False
-                )
-                st.dataframe(ops_ticket, use_container_width=True, hide_index=True)
-            
-            with tab2:
-                if not df_prov.empty:
-                    prov_ticket = df_prov[df_prov['ticket'] == ticket_escolhido]
-                    if not prov_ticket.empty:
-                        st.dataframe(prov_ticket, use_container_width=True, hide_index=True)
-                        st.metric("💰 Total Proventos", f"R$ {prov_ticket['valor'].sum():.2f}")
-                    else:
-                        st.info("📭 Sem proventos para este ticket")
-                else:
-                    st.info("📭 Sem proventos registrados")
-            
-            with tab3:
-                pos_ticket = df_pos[df_pos['Ticket'] == ticket_escolhido]
-                
-                if not pos_ticket.empty:
-                    col1, col2, col3 = st.columns(3)
-                    col1.metric("🔢 Quantidade", int(pos_ticket.iloc[0]['Quantidade']))
-                    col2.metric("💵 Preço Médio", f"R$ {pos_ticket.iloc[0]['Preço Médio']:.2f}")
-                    col3.metric("💼 Total Investido", f"R$ {pos_ticket.iloc[0]['Total']:.2f}")
-                else:
-                    st.info("📭 Sem posição atual neste ativo")
-        else:
-            st.info("📭 Nenhuma operação registrada")
+        historico_ticket(df_ops, df_prov, df_pos)
     
     elif pag == "⚙️ Gestão de Dados":
         st.header("⚙️ Central de Gestão")
@@ -1706,26 +2102,43 @@ else:
             st.subheader("Editar Operações")
             st.warning("⚠️ Edições afetarão todos os cálculos. Use com cautela!")
             
-            if not df_ops.empty:
+            if existem_operacoes():
+                total_paginas = max(1, -(-len(df_ops) // TAMANHO_PAGINA_EDITOR))
+                pagina = 1
+                if total_paginas > 1:
+                    pagina = st.number_input(
+                        f"Página (de {total_paginas})",
+                        min_value=1,
+                        max_value=total_paginas,
+                        step=1,
+                        key="pagina_editor"
+                    )
+                df_ops_pagina = carregar_pagina_operacoes(pagina - 1)
+                
                 edited_ops = st.data_editor(
-                    df_ops,
+                    df_ops_pagina,
+                    column_config={'id': st.column_config.NumberColumn(disabled=True)},
                     use_container_width=True,
                     num_rows="dynamic",
-                    key="editor_ops",
+                    key=f"editor_ops_{pagina}",
                     hide_index=False
                 )
                 
                 if st.button("💾 Salvar Alterações", type="primary"):
-                    conn = sqlite3.connect('investimentos.db')
-                    conn.execute("DELETE FROM operacoes")
-                    edited_ops.to_sql('operacoes', conn, index=False, if_exists='append')
-                    conn.commit()
-                    conn.close()
-                    
-                    carregar_dados.clear()
-                    
-                    st.success("✅ Operações atualizadas!")
-                    st.rerun()
+                    # Nada foi editado: evita reescrever a tabela inteira
+                    if edited_ops.equals(df_ops_pagina):
+                        st.info("ℹ️ Sem alterações para salvar")
+                    else:
+                        erros = salvar_operacoes_editadas(edited_ops, df_ops_pagina)
+                        
+                        if erros:
+                            for erro in erros:
+                                st.error(erro)
+                        else:
+                            invalidar_caches()
+                            
+                            st.success("✅ Operações atualizadas!")
+                            st.rerun()
             else:
                 st.info("📭 Sem operações para editar")
         
@@ -1739,6 +2152,7 @@ else:
                 if st.button("📦 Criar Backup Agora", use_container_width=True):
                     sucesso, mensagem = fazer_backup()
                     if sucesso:
+                        listar_backups.clear()
                         st.success(f"✅ {mensagem}")
                     else:
                         st.error(f"❌ {mensagem}")
@@ -1753,7 +2167,7 @@ else:
                     if st.button("♻️ Restaurar Backup", use_container_width=True):
                         sucesso, mensagem = restaurar_backup(backup_escolhido)
                         if sucesso:
-                            carregar_dados.clear()
+                            invalidar_caches()
                             st.success(f"✅ {mensagem}")
                             st.rerun()
                         else:
@@ -1770,21 +2184,15 @@ else:
             with col1:
                 if st.button("🗑️ Limpar Todas Operações", use_container_width=True):
                     if st.checkbox("Confirmo que quero limpar TODAS as operações"):
-                        conn = sqlite3.connect('investimentos.db')
-                        conn.execute("DELETE FROM operacoes")
-                        conn.commit()
-                        conn.close()
-                        carregar_dados.clear()
+                        limpar_tabela('operacoes')
+                        invalidar_caches()
                         st.success("✅ Operações limpas!")
                         st.rerun()
             
             with col2:
                 if st.button("🗑️ Limpar Todos Proventos", use_container_width=True):
                     if st.checkbox("Confirmo que quero limpar TODOS os proventos"):
-                        conn = sqlite3.connect('investimentos.db')
-                        conn.execute("DELETE FROM proventos")
-                        conn.commit()
-                        conn.close()
-                        carregar_dados.clear()
+                        limpar_tabela('proventos')
+                        invalidar_caches()
                         st.success("✅ Proventos limpos!")
                         st.rerun()
\ No newline at end of file